@@ -0,0 +1,60 @@
+"""
+Running model-level totals of per-agent quantities.
+"""
+import numpy as np
+
+
+class Tally():
+    """Cached per-agent values of one quantity (utility, specialization)
+    with their running sum, kept current by applying only the agents whose
+    value changed. spread=True also keeps the sum of squares for the
+    variance; min and max are read off the cached values.
+
+    The running sums are recomputed from scratch every `resync` updates so
+    floating point error can't build up over a long run.
+    """
+    def __init__(self, values, spread=False, resync=1000):
+        self.values = np.array(values, dtype=float)
+        self.spread = spread
+        self.resync = resync
+        self.resum()
+
+    def resum(self):
+        self.updates = 0
+        self.total = self.values.sum()
+        if self.spread:
+            self.squares = (self.values ** 2).sum()
+
+    def update(self, ids, new):
+        """Agents `ids` now have values `new`"""
+        new = np.asarray(new, dtype=float)
+        old = self.values[ids]
+        self.values[ids] = new
+        self.updates += 1
+        if self.updates >= self.resync:
+            self.resum()
+            return
+        self.total += (new - old).sum()
+        if self.spread:
+            self.squares += (new ** 2 - old ** 2).sum()
+
+    def replace(self, new):
+        """Every agent has a new value"""
+        self.values[:] = new
+        self.resum()
+
+    @property
+    def mean(self):
+        return self.total / len(self.values)
+
+    @property
+    def var(self):
+        return self.squares / len(self.values) - self.mean ** 2
+
+    @property
+    def min(self):
+        return self.values.min()
+
+    @property
+    def max(self):
+        return self.values.max()
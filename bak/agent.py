@@ -1,36 +1,66 @@
 # Libraries
 import numpy as np
-import pandas as pd
 from mesa import Agent
-import copy
-# from model import compare
 # from functools import reduce
 
 
+def utility_reporter(agent):
+    """How much utility does agent have right now?"""
+    return agent.utility()
+
+
+def specialization_reporter(agent):
+    """How much of agent's time is spent on their most popular good?"""
+    return agent.prod_plan.max() / agent.prod_plan.sum()
+
+
+def compare(vect, basis):
+    """Compare a vector to some basis. Used to map a deal and an agent's ppf
+    to a real number. If that number is positive, it means they come out ahead
+    on the deal relative to no ability to trade."""
+    out = vect * (basis[..., :1] / basis)
+    return out.sum(axis=-1)  # check this.
+
+
+def _row(name):
+    """Property for this agent's row of one of the model's arrays"""
+    def fget(self):
+        return getattr(self.model, name)[self.row]
+
+    def fset(self, value):
+        getattr(self.model, name)[self.row] = value
+    return property(fget, fset)
+
+
 class BarterAgent(Agent):
     """
     An agent with preferences and capabilities
     that produces and trades to enhance utility.
+
+    Its state lives in row `row` of the model's arrays (see Market), so
+    the whole population can also be stepped at once.
     """
-    def __init__(self, unique_id, model):
+    production = _row("production")
+    trades = _row("trades")
+    ppf = _row("ppf")
+    prices = _row("prices")
+    endowment = _row("endowment")
+    u_params = _row("u_params")
+    trades_done = _row("trades_done")
+    cumulative_utility = _row("cumulative_utility")
+
+    def __init__(self, unique_id, model, row):
         super().__init__(unique_id, model)
-        self.production = np.ones(model.K)
-        self.trades = np.ones(model.possible_trades.shape[0])
-        self.ppf = np.random.randint(1, 4, model.K)
-        # maximum prices are defined by the slope of the ppf
-        self.prices = [self.ppf[y]/self.ppf[x]
-                       for (x, y) in model.possible_trades]
-        self.endowment = np.random.randint(10, 20, model.K)
-        u_params = np.random.randint(1, 4, model.K)
-        self.u_params = u_params / u_params.sum()
-        self.history = pd.DataFrame({
-            "initiator": [],
-            "partner": [],
-            "deal": [],
-            "trades": []
-        })
-        self.trades_done = 0
-        self.cumulative_utility = 0
+        self.row = row
+
+    @property
+    def prod_plan(self):
+        return self.production / self.production.sum()
+
+    @property
+    def history(self):
+        """This agent's trades, from the model's history arrays"""
+        return self.model.history_frame(self.row)
 
     def step(self):
         self.produce()
@@ -38,11 +68,7 @@ class BarterAgent(Agent):
         self.consume()
 
     def produce(self, factor=1):
-        plan = self.production / self.production.sum()
-        prod = plan * self.ppf
-        prod = plan * factor
-        prod = int(prod)
-        self.endowment += prod
+        self.endowment += self.prod_plan * self.ppf * factor
         return self
 
     def consume(self, units=5):
@@ -54,44 +80,36 @@ class BarterAgent(Agent):
         eat = np.random.choice(range(self.model.K),
                                size=units,
                                replace=True, p=probs)
-        for e in eat:
-            self.endowment[e] -= 1
-            # this is sort of a goofy way to track utility. I'll fix it later
-            self.cumulative_utility += self.u_params[e]
+        self.endowment -= np.bincount(eat, minlength=self.model.K)
+        # this is sort of a goofy way to track utility. I'll fix it later
+        self.cumulative_utility += self.u_params[eat].sum()
         return self
 
     def trade(self, partner, complexity=1):
         prob = self.trades / self.trades.sum()
-        index = np.random.randint(range(self.model.possible_trades.size[0]),
-                                  size=complexity,
-                                  replace=True,
-                                  p=prob)
-        trades = self.model.possible_trades.loc[index]
-        prices = [(1, np.random.randint(1, self.prices[i])) for i in index]
-        prices = np.array(prices)
+        index = np.random.choice(len(self.model.possible_trades),
+                                 size=complexity,
+                                 replace=True,
+                                 p=prob)
+        trades = self.model.possible_trades[index]
+        prices = np.ones((complexity, 2))
+        prices[:, 1] = np.random.uniform(0, self.prices[index])
         deal = self.vectorize_deal(trades, prices)
         # But this is also a place for a price expectation vector...
         # Currently just comparing the deal to agents' ppfs
         # But we could allow more elaborate behavior:
-        # * Check self.model.history.filter(contains(trades))
+        # * Check self.model.history_frame() for past deals in these goods
         # * Create and learn some price expectation vector
         good_for_goose = compare(deal, self.ppf) > 0
         good_for_gander = compare(-deal, partner.ppf) > 0
-        if not good_for_goose or not good_for_gander:
+        affordable = (self.endowment + deal >= 0).all() and \
+            (partner.endowment - deal >= 0).all()
+        if not good_for_goose or not good_for_gander or not affordable:
             self.solo_update()
             return self
-        else:
-            hist_update = pd.DataFrame({
-                "initiator": [self],
-                "partner": [partner],
-                "deal": [deal],
-                "trades": [trades]
-            })
-            self.history = pd.concat([self.history, hist_update])
-            partner.history = pd.concat([partner.history, hist_update])
-            self.model.history = pd.concat([self.model.history, hist_update])
-            self.update()
-            partner.update()
+        self.model.record([self.row], [partner.row], deal[None], index[:1])
+        self.update(deal, index)
+        partner.update(-deal)
         return self
 
     def find_partner(self):
@@ -102,61 +120,52 @@ class BarterAgent(Agent):
         return partner
 
     def solo_update(self):
-        """update production plans"""
-        baseline = self.produce().utility()
-        self.produce(-1)
-        mutation = self.random_mutation()
-        doppelganger = copy.deepcopy(self).mutate(mutation)
-        if doppelganger.produce().utility() > baseline:
-            self.production.loc[mutation] += 1
+        """Try out a random mutation and keep it if it would leave me
+        better off after a day's production. The mutated agent is only
+        ever array math (Market.counterfactual), never a copy."""
+        keys, index = self.model.random_mutations(1)
+        if self.model.counterfactual(np.array([self.row]), keys, index)[0]:
+            self.mutate(**self.model.mutation(keys[0], index[0]))
         return self
 
-    def update(self):
+    def update(self, deal, index=None):
         """Produce more of what I have comparative
         advantage in... Or, if I can't trade, whatever
         gives me greater expected utility."""
-        last_deal = self.history.tail(1)
-        if last_deal["initiator"] == self:
-            self.endowment += last_deal["deal"]
-        else:
-            self.endowment -= last_deal["deal"]
-        self.trades_undertaken += 1
-        # self.prod_plan[last_deal["deal"]] += 1
+        self.endowment += deal
+        self.trades_done += 1
         # update prod_plan to make more of something I sold
-        make_more_of = last_deal["trades"][1][1]
-        self.production.loc[make_more_of] += 1
-        self.trades.loc[self.trades == last_deal["trades"]] += 1
+        self.production[deal < 0] += 1
+        # and, if I proposed it, go back to the kind of trade that worked
+        if index is not None:
+            self.trades[index] += 1
         return self
 
     def utility(self):
         """Calculate utility based on endowment and Cobb-Douglas preferences"""
-        (self.endowment ** self.u_params).sum()
+        return (self.endowment ** self.u_params).sum()
 
     def vectorize_deal(self, trades, quantities):
+        """Net change in my goods from trades (buy, sell) at quantities
+        (bought, paid)"""
         deal = np.zeros(self.model.K)
-        for (t1, t2), (p1, p2) in trades, quantities:
-            deal[t1] += p1
-            deal[t2] -= p2
+        np.add.at(deal, trades[:, 0], quantities[:, 0])
+        np.add.at(deal, trades[:, 1], -quantities[:, 1])
         return deal
 
     def reproduce(self, **mutations):
-        baby = copy.deepcopy(self)
-        baby.history = pd.DataFrame({
-            "initiator": [],
-            "partner": [],
-            "deal": [],
-            "trades": []
-        })
+        row = self.model.add_rows([self.row])[0]
+        baby = BarterAgent(self.model.next_id(), self.model, row)
         baby.trades_done = 0
         baby.cumulative_utility = 0
         if mutations:
-            baby = baby.mutate(mutations)
+            baby = baby.mutate(**mutations)
         # add to schedule
         self.model.schedule.add(baby)
         return baby
 
     def mutate(self, **mutations):
-        for key, value in mutations:
+        for key, value in mutations.items():
             if key == "production":
                 self.production += value
             if key == "trade":
@@ -166,17 +175,14 @@ class BarterAgent(Agent):
                 self.u_params = self.u_params / self.u_params.sum()
             if key == "ppf":
                 self.ppf += value
-                self.prices = [self.ppf[y]/self.ppf[x]
-                               for (x, y)
-                               in self.model.possible_trades]
+                self.prices = self.model.price_table(self.ppf[None])[0]
             if key == "endowment":
                 self.endowment += value
         return self
 
     def random_mutation(self):
-        options = ["production", "trade", "u_params", "ppf", "endowment"]
-        prob = np.array([10, 10, 2, 2, 1])
-        prob = prob / prob.sum()
-        key = np.random.choice(options, 1, p=prob)
-        value = 1
-        return {key: value}
+        """One unit more of a single randomly chosen good (or kind of
+        trade) in one of my production, trade, u_params, ppf or endowment
+        vectors, as {key: vector to add}"""
+        keys, index = self.model.random_mutations(1)
+        return self.model.mutation(keys[0], index[0])
@@ -1,47 +1,268 @@
 # Libraries
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 from mesa import Model
 from mesa.time import RandomActivation
 from mesa.datacollection import DataCollector
-from agent import BarterAgent
-# from model import utility_reporter
-# from model import specialization_reporter
+from agent import BarterAgent, compare
+from agent import utility_reporter
+from agent import specialization_reporter
+
+# Per-agent state, one row per agent (see BarterAgent)
+ROWS = ("production", "trades", "ppf", "prices", "endowment", "u_params",
+        "trades_done", "cumulative_utility")
+# What random_mutations can change, and how often
+MUTATIONS = np.array(["production", "trade", "u_params", "ppf", "endowment"])
+MUTATION_ODDS = np.array([10, 10, 2, 2, 1]) / 25
+
+
+@lru_cache(maxsize=None)
+def trade_pairs(K):
+    """Every ordered pair of distinct goods as a read-only K(K-1) x 2
+    array of (buy, sell), built once per K and shared"""
+    buy, sell = np.nonzero(~np.eye(K, dtype=bool))
+    pairs = np.stack([buy, sell], axis=1)
+    pairs.flags.writeable = False
+    return pairs
 
 
 class Market(Model):
     """
     An economy with N agents and K goods
+
+    With batched=False each BarterAgent steps in turn, as scheduled. With
+    batched=True the whole population steps at once (batch_step): every
+    agent proposes one trade to the next agent in a shuffled cycle, and
+    the agents whose trades fall through all try their mutations in one
+    call to counterfactual.
     """
-    def __init__(self, N, K):
+    def __init__(self, N, K, batched=False):
         super().__init__()
         self.N = int(N)
         self.K = int(K)
+        self.batched = batched
         self.schedule = RandomActivation(self)
-        self.history = pd.DataFrame({
-            "initiator": [],
-            "partner": [],
-            "deal": [],
-            "trades": []
-        })
         self.trades_undertaken = 0
         self.possible_trades = self.generate_possible_trades(K)
+        self.init_rows(self.N)
+        self.init_history(16 * self.N)
         # create agents
         for i in range(N):
-            a = BarterAgent(self.next_id(), self)
+            a = BarterAgent(self.next_id(), self, i)
             self.schedule.add(a)
         # collect data
         self.datacollector = DataCollector(
-            model_reporters={"Number of trades": "self.trades_undertaken"},
+            model_reporters={"Number of trades": "trades_undertaken"},
             agent_reporters={"Utility": utility_reporter,
                              "Specialization": specialization_reporter}
         )
 
     def step(self):
         self.datacollector.collect(self)
-        self.schedule.step()
+        if self.batched:
+            self.batch_step()
+        else:
+            self.schedule.step()
 
     def generate_possible_trades(self, K):
-        poss_trades = [(x, y) for x in range(K) for y in range(K) if x != y]
-        poss_trades = pd.DataFrame(poss_trades)
-        poss_trades.rename(columns={'0': 'buy', '1': 'sell'}, inplace=True)
-        return poss_trades
+        return trade_pairs(K)
+
+    def init_rows(self, N):
+        """Draw the starting state of N agents"""
+        K = self.K
+        self.production = np.ones((N, K))
+        self.trades = np.ones((N, len(self.possible_trades)))
+        self.ppf = np.random.randint(1, 4, (N, K)).astype(float)
+        # maximum prices are defined by the slope of the ppf
+        self.prices = self.price_table(self.ppf)
+        self.endowment = np.random.randint(10, 20, (N, K)).astype(float)
+        u_params = np.random.randint(1, 4, (N, K))
+        self.u_params = u_params / u_params.sum(axis=1, keepdims=True)
+        self.trades_done = np.zeros(N, dtype=int)
+        self.cumulative_utility = np.zeros(N)
+
+    def add_rows(self, rows):
+        """Copy agents' rows to the end of every array; returns the new
+        rows"""
+        start = len(self.endowment)
+        for name in ROWS:
+            values = getattr(self, name)
+            setattr(self, name, np.concatenate([values, values[rows]]))
+        return list(range(start, start + len(rows)))
+
+    def price_table(self, ppf):
+        """Each agent's maximum price for each possible trade: how much of
+        what it sells it could make in the time it takes to make one unit
+        of what it buys"""
+        ppf = np.asarray(ppf, dtype=float)
+        buy, sell = self.possible_trades.T
+        return ppf[:, sell] / ppf[:, buy]
+
+    def init_history(self, capacity):
+        """Preallocated arrays for the trades made, grown by doubling"""
+        self.history_size = 0
+        self.hist_step = np.zeros(capacity, dtype=int)
+        self.hist_initiator = np.zeros(capacity, dtype=int)
+        self.hist_partner = np.zeros(capacity, dtype=int)
+        self.hist_trade = np.zeros(capacity, dtype=int)
+        self.hist_deal = np.zeros((capacity, self.K))
+
+    def record(self, initiators, partners, deals, trades):
+        """Add trades to the history: the rows of the agents on either
+        side, the initiator's deal and the index of the possible trade"""
+        start = self.history_size
+        end = start + len(initiators)
+        if end > len(self.hist_step):
+            capacity = max(end, 2 * len(self.hist_step))
+            for name in ("hist_step", "hist_initiator", "hist_partner",
+                         "hist_trade", "hist_deal"):
+                values = getattr(self, name)
+                grown = np.zeros((capacity,) + values.shape[1:],
+                                 dtype=values.dtype)
+                grown[:start] = values[:start]
+                setattr(self, name, grown)
+        self.hist_step[start:end] = self.schedule.steps
+        self.hist_initiator[start:end] = initiators
+        self.hist_partner[start:end] = partners
+        self.hist_trade[start:end] = trades
+        self.hist_deal[start:end] = deals
+        self.history_size = end
+        self.trades_undertaken += end - start
+
+    def history_frame(self, row=None):
+        """The history as a DataFrame, optionally only the trades agent
+        `row` was part of"""
+        n = self.history_size
+        keep = np.arange(n)
+        if row is not None:
+            keep = keep[(self.hist_initiator[:n] == row) |
+                        (self.hist_partner[:n] == row)]
+        return pd.DataFrame({
+            "step": self.hist_step[keep],
+            "initiator": self.hist_initiator[keep],
+            "partner": self.hist_partner[keep],
+            "deal": list(self.hist_deal[keep]),
+            "trades": self.hist_trade[keep]
+        })
+
+    @property
+    def history(self):
+        return self.history_frame()
+
+    def utility(self):
+        """Every agent's utility"""
+        return (self.endowment ** self.u_params).sum(axis=1)
+
+    @staticmethod
+    def day_utility(production, ppf, endowment, u_params):
+        """Utility after one more day's production, row by row"""
+        plan = production / production.sum(axis=1, keepdims=True)
+        return ((endowment + plan * ppf) ** u_params).sum(axis=1)
+
+    def random_mutations(self, n):
+        """n random mutations, as the vector each changes and the good (or
+        kind of trade) in it that gets one unit more"""
+        keys = MUTATIONS[np.random.choice(len(MUTATIONS), size=n,
+                                          p=MUTATION_ODDS)]
+        size = np.where(keys == "trade", len(self.possible_trades), self.K)
+        index = (np.random.random(n) * size).astype(int)
+        return keys, index
+
+    def mutation(self, key, index):
+        """One of random_mutations as BarterAgent.mutate takes it"""
+        size = len(self.possible_trades) if key == "trade" else self.K
+        value = np.zeros(size)
+        value[index] = 1
+        return {key: value}
+
+    def counterfactual(self, rows, keys, index):
+        """Would agent rows[i] be better off after a day's production with
+        mutation (keys[i], index[i])? Every agent's state and its mutant's
+        are stacked into one set of arrays and go through day_utility
+        together. A trade mutation doesn't change production, so it is
+        never better."""
+        n = len(rows)
+        production = np.tile(self.production[rows], (2, 1))
+        ppf = np.tile(self.ppf[rows], (2, 1))
+        endowment = np.tile(self.endowment[rows], (2, 1))
+        u_params = np.tile(self.u_params[rows], (2, 1))
+        mutant = np.arange(n, 2 * n)
+        for key, values in (("production", production),
+                            ("u_params", u_params),
+                            ("ppf", ppf),
+                            ("endowment", endowment)):
+            hit = keys == key
+            values[mutant[hit], index[hit]] += 1
+        u_params[n:] /= u_params[n:].sum(axis=1, keepdims=True)
+        utility = self.day_utility(production, ppf, endowment, u_params)
+        return utility[n:] > utility[:n]
+
+    def apply_mutations(self, rows, keys, index):
+        """BarterAgent.mutate for many agents at once; rows are distinct"""
+        for key, values in (("production", self.production),
+                            ("trade", self.trades),
+                            ("u_params", self.u_params),
+                            ("ppf", self.ppf),
+                            ("endowment", self.endowment)):
+            hit = keys == key
+            values[rows[hit], index[hit]] += 1
+        hit = rows[keys == "u_params"]
+        self.u_params[hit] /= self.u_params[hit].sum(axis=1, keepdims=True)
+        hit = rows[keys == "ppf"]
+        self.prices[hit] = self.price_table(self.ppf[hit])
+
+    def batch_step(self, units=5):
+        """Step every agent at once. Since each agent is in two trades, one
+        it proposed and one proposed to it, neither side of a trade gives
+        up more than half of what it holds."""
+        n = len(self.endowment)
+        rows = np.arange(n)
+        self.endowment += (self.production /
+                           self.production.sum(axis=1, keepdims=True) *
+                           self.ppf)
+        # everyone proposes to the next agent in a shuffled cycle
+        order = np.random.permutation(n)
+        partner = np.empty(n, dtype=int)
+        partner[order] = np.roll(order, -1)
+        cum = np.cumsum(self.trades, axis=1)
+        draw = np.random.random(n) * cum[:, -1]
+        index = (cum <= draw[:, None]).sum(axis=1)
+        buy, sell = self.possible_trades[index].T
+        price = np.random.uniform(0, self.prices[rows, index])
+        deal = np.zeros((n, self.K))
+        deal[rows, buy] += 1
+        deal[rows, sell] -= price
+        ok = ((compare(deal, self.ppf) > 0) &
+              (compare(-deal, self.ppf[partner]) > 0) &
+              (self.endowment[rows, sell] / 2 >= price) &
+              (self.endowment[partner, buy] / 2 >= 1))
+        init, part, deal = rows[ok], partner[ok], deal[ok]
+        self.endowment[init] += deal
+        self.endowment[part] -= deal
+        self.trades_done[init] += 1
+        self.trades_done[part] += 1
+        # make more of what was sold, and reinforce the trade that worked
+        self.production[init, sell[ok]] += 1
+        self.production[part, buy[ok]] += 1
+        self.trades[init, index[ok]] += 1
+        self.record(init, part, deal, index[ok])
+        # the rest try a mutation, all at once
+        failed = rows[~ok]
+        keys, mutated = self.random_mutations(len(failed))
+        better = self.counterfactual(failed, keys, mutated)
+        self.apply_mutations(failed[better], keys[better], mutated[better])
+        # consume
+        eating = rows[self.endowment.min(axis=1) >= units]
+        cum = np.cumsum(self.u_params[eating], axis=1)
+        draw = np.random.random((len(eating), units))
+        eat = (cum[:, None, :] <= draw[:, :, None]).sum(axis=2)
+        eat = np.minimum(eat, self.K - 1)
+        eaten = np.zeros((len(eating), self.K))
+        np.add.at(eaten, (np.repeat(np.arange(len(eating)), units),
+                          eat.ravel()), 1)
+        self.endowment[eating] -= eaten
+        self.cumulative_utility[eating] += np.take_along_axis(
+            self.u_params[eating], eat, axis=1).sum(axis=1)
+        self.schedule.steps += 1
+        self.schedule.time += 1
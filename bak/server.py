@@ -9,12 +9,13 @@ class utility_element(TextElement):
         pass
 
     def render(self, model):
-        return "Mean utility: " + str(model.Utility.mean())
+        return "Mean utility: " + str(model.utility().mean())
 
 
 model_params = {
     "N": UserSettableParameter("slider", "N", 2, 2, 10, 1),
     "K": UserSettableParameter("slider", "K", 2, 2, 10, 1),
+    "batched": UserSettableParameter("checkbox", "Batched", False),
 }
 
 server = ModularServer(
@@ -0,0 +1,485 @@
+"""
+Benchmarks for mkt.
+
+    python bench.py run -o base.json            # the suite, saved as JSON
+    python bench.py run --N 1000 --K 2 10 --engine vector
+    python bench.py compare base.json new.json  # flag regressions
+    python bench.py compare base.json new.json --baseline a.json b.json
+    python bench.py engines                     # per-agent vs vectorized
+    python bench.py trade                       # trade clearing only
+    python bench.py check                       # do the engines agree?
+    python bench.py ensemble                    # batched replicates
+    python bench.py memory                      # bytes per agent and step
+    python bench.py sparse                      # dense vs top-k goods
+    python bench.py parallel                    # steps split over workers
+    python bench.py startup                     # process start to step 1
+
+The suite times mkt.__init__, a full mkt.step and each phase on its own
+for every combination of N, K and engine, and records steps/sec,
+trades/sec and peak RSS. Each timing is the fastest of its repeats, and
+how much slower the median repeat was is kept as its noise. Each case
+runs in a fresh process so its peak RSS is its own.
+
+check compares the engines' statistics; the exact checks (kernels against
+hand-worked amounts, restore, fork and parallel runs against serial ones)
+are tests, in tests/: python -m pytest
+"""
+import argparse
+import json
+import platform
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import numpy as np
+import kernels
+from model import mkt, exchange
+from ensemble import Ensemble
+from parallel import Workers
+
+
+def time_engine(N, K=2, steps=5, vectorized=False):
+    """Seconds per step spent advancing the agents (data collection and
+    model means are left out so only the engine is timed)."""
+    model = mkt(N, K, vectorized=vectorized)
+    advance = model.vector_step if vectorized else model.schedule.step
+    start = time.perf_counter()
+    for _ in range(steps):
+        advance()
+    return (time.perf_counter() - start) / steps
+
+
+def compare_engines(sizes=(1000, 10000, 100000), K=2, steps=5):
+    print("%8s %12s %12s %9s" % (
+        "N", "agent s/step", "vector s/step", "speedup"))
+    for N in sizes:
+        slow = time_engine(N, K, steps, vectorized=False)
+        fast = time_engine(N, K, steps, vectorized=True)
+        print("%8d %12.5f %12.5f %8.1fx" % (N, slow, fast, slow / fast))
+
+
+def halving_trade(model):
+    """The trade phase as it used to run: one exchange per agent, sized
+    down by repeated halving."""
+    for agent in model.ants:
+        partner = agent.find_partner()
+        give = agent.prod_plan * agent.ppf
+        take = partner.prod_plan * partner.ppf
+        while not (agent.has(give) and partner.has(take)):
+            give *= 0.5
+            take *= 0.5
+        exchange([agent, partner], model, [give, take]).undertake()
+
+
+def compare_trade(sizes=(100, 1000, 10000), K=2, steps=5):
+    """Time the trade phase alone: the old per-agent halving loop against
+    the batched clearing kernel. Endowments are shrunk first so trades
+    need plenty of halving."""
+    print("%8s %12s %12s %9s" % (
+        "N", "loop s/step", "kernel s/step", "speedup"))
+    for N in sizes:
+        model = mkt(N, K)
+        for agent in model.ants:
+            agent.endowment = agent.endowment / 1000
+        start = time.perf_counter()
+        for _ in range(steps):
+            halving_trade(model)
+        slow = (time.perf_counter() - start) / steps
+        model = mkt(N, K, vectorized=True)
+        model.endowment /= 1000
+        start = time.perf_counter()
+        for _ in range(steps):
+            kernels.trade(model.endowment, model.prod_plan, model.ppf,
+                          model.learning_rate, ledger=model.ledger)
+        fast = (time.perf_counter() - start) / steps
+        print("%8d %12.5f %12.5f %8.1fx" % (N, slow, fast, slow / fast))
+
+
+def check_equivalence(N=50, K=2, steps=50, reps=20):
+    """Final mean utility / specialization from both engines over a few
+    replicates, for eyeballing that they agree."""
+    for vectorized in (False, True):
+        util, spec = [], []
+        for _ in range(reps):
+            model = mkt(N, K, vectorized=vectorized)
+            for _ in range(steps):
+                model.step()
+            util.append(model.mean_utility)
+            spec.append(model.mean_specialization)
+        name = "vector" if vectorized else "agent"
+        print("%6s utility %.2f +/- %.2f  specialization %.3f +/- %.3f" % (
+            name, np.mean(util), np.std(util), np.mean(spec), np.std(spec)))
+
+
+def compare_ensemble(M=200, N=50, K=2, steps=100, loops=5):
+    """Replicate-steps per second of one Ensemble of M replicates against
+    looping over separate mkt runs (timed for `loops` of them)"""
+    runs = Ensemble(M, N, K, seed=0)
+    runs.consume = True
+    start = time.perf_counter()
+    runs.run(steps)
+    rates = {"ensemble": M * steps / (time.perf_counter() - start)}
+    for name, vectorized in (("mkt (agent)", False), ("mkt (vector)", True)):
+        start = time.perf_counter()
+        for seed in range(loops):
+            model = mkt(N, K, vectorized=vectorized, seed=seed)
+            model.consume = True
+            for _ in range(steps):
+                model.step()
+        rates[name] = loops * steps / (time.perf_counter() - start)
+    print("M=%d N=%d K=%d, %d steps" % (M, N, K, steps))
+    for name, rate in rates.items():
+        print("%-14s %10.0f replicate-steps/s  (%.0fx mkt agent)" % (
+            name, rate, rate / rates["mkt (agent)"]))
+
+
+def measure_memory(N=10000, K=2, steps=3, **params):
+    """Bytes held per agent after construction, and bytes allocated per
+    agent (at the peak) during a step, as traced by tracemalloc. Steps
+    are taken without data collection, whose records would otherwise
+    swamp the agents' own allocations."""
+    tracemalloc.start()
+    # a ring-buffer ledger, so its growth doesn't count as the step's
+    model = mkt(N, K, seed=0, ledger_size=N, **params)
+    held = tracemalloc.get_traced_memory()[0]
+    model.consume = True
+    model.advance()  # first-step allocations (ledger growth) aside
+    transient = 0
+    for _ in range(steps):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        model.advance()
+        transient = max(transient, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return held / N, transient / N
+
+
+def compare_memory(N=10000, K=2):
+    """measure_memory for the default per-agent model against compact mode
+    with 64 and 32 bit floats"""
+    print("N=%d K=%d  bytes per agent: held, allocated in a step" % (N, K))
+    for name, params in (("default", {}),
+                         ("compact", {"compact": True}),
+                         ("compact float32", {"compact": True,
+                                              "dtype": np.float32})):
+        held, transient = measure_memory(N, K, **params)
+        print("%-16s %8.0f %8.0f" % (name, held, transient))
+
+
+def compare_sparse(N=10000, goods=(10, 100, 1000), top_k=5, steps=5):
+    """Vectorized step time with every agent dealing in all K goods
+    against each dealing in only top_k of them"""
+    print("N=%d, seconds per step" % N)
+    print("%6s %10s %10s" % ("K", "dense", "top_%d" % top_k))
+    for K in goods:
+        times = []
+        for k in (None, top_k):
+            model = mkt(N, K, vectorized=True, seed=0, top_k=k)
+            model.consume = True
+            times.append(time_call(model.step, steps))
+        print("%6d %10.4f %10.4f" % (K, *times))
+
+
+def compare_parallel(N=1000000, K=5, workers=(1, 2, 4, 8), steps=5):
+    """Vectorized step time serially and split over worker processes"""
+    print("N=%d, K=%d" % (N, K))
+    print("%8s %10s %9s" % ("workers", "s/step", "speedup"))
+    model = mkt(N, K, vectorized=True, seed=0, collector="array",
+                ledger_size=N)
+    model.consume = True
+    model.step()  # warm up
+    serial = time_call(model.step, steps)
+    print("%8s %10.4f %9s" % ("serial", serial, ""))
+    for n in workers:
+        with Workers(model, n):
+            model.step()
+            seconds = time_call(model.step, steps)
+        print("%8d %10.4f %8.1fx" % (n, seconds, serial / seconds))
+
+
+def time_startup(reps=5):
+    """Wall-clock seconds for a fresh interpreter to do each of: nothing,
+    import model, import the visualization server, and run one step of
+    a small model with python -m headless"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        config = os.path.join(tmp, "run.json")
+        with open(config, "w") as f:
+            json.dump({"N": 1000, "K": 2, "vectorized": True, "steps": 1,
+                       "output": tmp}, f)
+        commands = {"python": ["-c", "pass"],
+                    "import model": ["-c", "import model"],
+                    "import server": ["-c", "import server"],
+                    "headless, 1 step": ["-m", "headless", config, "-q"]}
+        print("%18s %8s" % ("", "seconds"))
+        for name, args in commands.items():
+            times = []
+            for _ in range(reps):
+                start = time.perf_counter()
+                subprocess.run([sys.executable] + args, cwd=here, check=True)
+                times.append(time.perf_counter() - start)
+            print("%18s %8.3f" % (name, min(times)))
+
+
+def time_calls(fn, reps):
+    """Seconds taken by each of reps calls of fn"""
+    return timeit.repeat(fn, repeat=reps, number=1)
+
+
+def time_call(fn, reps):
+    """Fastest of reps calls of fn, in seconds: anything slower is the
+    machine getting in the way"""
+    return min(time_calls(fn, reps))
+
+
+def noise(times):
+    """How far the median call was above the fastest, as a fraction"""
+    return float(np.median(times) / min(times) - 1)
+
+
+def agent_phases(model, reps):
+    """Seconds taken by each of reps population-wide calls of each
+    per-agent phase"""
+    ants = model.ants
+    deals = [exchange([a, a.find_partner()], model) for a in ants]
+
+    def day_trade():
+        for deal in deals:
+            deal.day_trade()
+
+    def undertake():
+        for deal in deals:
+            deal.undertake()
+
+    phases = {
+        "move": lambda: [a.move() for a in ants],
+        "produce": lambda: [a.produce() for a in ants],
+        "find_partner": lambda: [a.find_partner() for a in ants],
+        "day_trade": day_trade,
+        "undertake": undertake,
+        "consume": lambda: [a.consume() for a in ants],
+        "solo_update": lambda: [a.solo_update() for a in ants],
+        "update_means": model.update_means,
+        "collect": lambda: model.datacollector.collect(model)}
+    return {name: time_calls(fn, reps) for name, fn in phases.items()}
+
+
+def vector_phases(model, reps):
+    """Seconds taken by each of reps calls of each batched phase"""
+    m = model
+    grid = m._grid
+    phases = {
+        "move": lambda: kernels.move(m.pos, grid.width, grid.height),
+        "produce": lambda: kernels.produce(m.endowment, m.prod_plan, m.ppf),
+        "trade": lambda: kernels.trade(m.endowment, m.prod_plan, m.ppf,
+                                       m.learning_rate, ledger=m.ledger),
+        "consume": lambda: kernels.consume(m.endowment, m.u_params),
+        "solo_update": lambda: kernels.solo_update(m.prod_plan, m.u_params,
+                                                   m.learning_rate),
+        "update_means": m.update_means,
+        "collect": lambda: m.datacollector.collect(m)}
+    return {name: time_calls(fn, reps) for name, fn in phases.items()}
+
+
+def run_case(engine, N, K, steps, reps):
+    """One benchmark case. Meant to run in its own process."""
+    vectorized = engine == "vector"
+    # mkt imports Mesa's DataCollector, and with it pandas, on first use;
+    # that's start-up cost (see startup), not init's
+    import mesa.datacollection  # noqa: F401
+    start = time.perf_counter()
+    model = mkt(N, K, vectorized=vectorized, seed=0)
+    init = time.perf_counter() - start
+    model.consume = True
+    trades = model.ledger.count
+    step_times = time_calls(model.step, steps)
+    trades = model.ledger.count - trades
+    phase_times = (vector_phases if vectorized else agent_phases)(model,
+                                                                  reps)
+    step = min(step_times)
+    phases = {name: min(times) for name, times in phase_times.items()}
+    spread = {"step": noise(step_times)}
+    spread.update({"phase." + name: noise(times)
+                   for name, times in phase_times.items()})
+    return {"engine": engine, "N": N, "K": K,
+            "init": init, "step": step, "phases": phases, "noise": spread,
+            "steps_per_sec": 1 / step,
+            "trades_per_sec": trades / sum(step_times),
+            "peak_rss_mb": resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def run_suite(sizes=(10, 100, 1000, 10000, 100000), goods=(2, 10, 50),
+              engines=("agent", "vector"), steps=3, reps=3,
+              max_agent_N=10000, path=None):
+    """Run every case, print a summary line for each and return (and
+    optionally save to path) the results as a dict."""
+    results = {"python": platform.python_version(),
+               "numpy": np.__version__,
+               "machine": platform.machine(),
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "cases": []}
+    print("%6s %7s %3s %9s %9s %11s %8s" % (
+        "engine", "N", "K", "init s", "steps/s", "trades/s", "RSS MB"))
+    context = get_context("spawn")
+    for engine in engines:
+        for N in sizes:
+            if engine == "agent" and N > max_agent_N:
+                continue
+            for K in goods:
+                with ProcessPoolExecutor(1, mp_context=context) as pool:
+                    case = pool.submit(run_case, engine, N, K, steps,
+                                       reps).result()
+                results["cases"].append(case)
+                print("%6s %7d %3d %9.4f %9.2f %11.0f %8.1f" % (
+                    engine, N, K, case["init"], case["steps_per_sec"],
+                    case["trades_per_sec"], case["peak_rss_mb"]))
+    if path is not None:
+        with open(path, "w") as f:
+            json.dump(results, f, indent=1)
+    return results
+
+
+def timings(case):
+    """Every timing in a case, flattened to name -> seconds"""
+    times = {"init": case["init"], "step": case["step"]}
+    times.update({"phase." + name: t for name, t in case["phases"].items()})
+    return times
+
+
+def log_ratios(old, new, floor=1e-4):
+    """(case, timing, log of new / old seconds, noise) for every timing
+    both runs have, where noise is twice the larger spread the two cases'
+    own repeats saw in it. Changes of less than `floor` seconds are left
+    out, as below that the timer is most of what's measured."""
+    before = {(c["engine"], c["N"], c["K"]): c for c in old["cases"]}
+    rows = []
+    for case in new["cases"]:
+        key = (case["engine"], case["N"], case["K"])
+        if key not in before:
+            continue
+        old_times = timings(before[key])
+        old_noise = before[key].get("noise", {})
+        for name, t in timings(case).items():
+            if name not in old_times or old_times[name] <= 0:
+                continue
+            if abs(t - old_times[name]) < floor:
+                continue
+            noise = 2 * max(old_noise.get(name, 0),
+                            case.get("noise", {}).get(name, 0))
+            rows.append((key, name, np.log(t / old_times[name]), noise))
+    return rows
+
+
+def compare(old, new, threshold=0.1, floor=1e-4, baseline=None):
+    """Print timings that got more than `threshold` slower (as a fraction)
+    between two saved runs, and return how many there were.
+
+    A timing's threshold is widened to twice the spread its own repeats
+    saw, and, given `baseline`, a pair of saved runs of the same code, to
+    three (robust) standard deviations of that pair's log ratios: how far
+    two runs differ on this machine when nothing changed. The noise is
+    never estimated from the runs being compared, where a regression
+    across a whole engine would pass for noise."""
+    spread = 0.
+    if baseline is not None:
+        logs = np.array([row[2] for row in log_ratios(*baseline, floor)])
+        if len(logs):
+            spread = 1.4826 * np.median(np.abs(logs - np.median(logs)))
+        print("run-to-run spread %.0f%%" % (100 * np.expm1(spread)))
+    rows = log_ratios(old, new, floor)
+    if not rows:
+        print("nothing to compare")
+        return 0
+    regressions = 0
+    for key, name, log, noise in rows:
+        allowed = max(np.log1p(threshold), 3 * spread, np.log1p(noise))
+        if log > allowed:
+            regressions += 1
+            print("REGRESSION %6s N=%-7d K=%-3d %-20s %.2fx slower" % (
+                *key, name, np.exp(log)))
+        elif log < -allowed:
+            print("improved   %6s N=%-7d K=%-3d %-20s %.2fx faster" % (
+                *key, name, np.exp(-log)))
+    print("%d regression(s) beyond %.0f%% and the noise" % (
+        regressions, 100 * threshold))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for mkt")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="run the benchmark suite")
+    run.add_argument("--N", type=int, nargs="+",
+                     default=[10, 100, 1000, 10000, 100000])
+    run.add_argument("--K", type=int, nargs="+", default=[2, 10, 50])
+    run.add_argument("--engine", choices=["agent", "vector", "both"],
+                     default="both")
+    run.add_argument("--steps", type=int, default=3)
+    run.add_argument("--reps", type=int, default=3)
+    run.add_argument("--max-agent-N", type=int, default=10000,
+                     help="skip larger N for the slow per-agent engine")
+    run.add_argument("-o", "--output")
+    cmp = sub.add_parser("compare", help="flag regressions between runs")
+    cmp.add_argument("old")
+    cmp.add_argument("new")
+    cmp.add_argument("--threshold", type=float, default=0.1)
+    cmp.add_argument("--floor", type=float, default=1e-4,
+                     help="ignore changes of fewer seconds than this")
+    cmp.add_argument("--baseline", nargs=2, metavar=("A", "B"),
+                     help="two runs of the same code, to measure the "
+                     "machine's run-to-run noise from")
+    sub.add_parser("engines", help="per-agent vs vectorized step time")
+    sub.add_parser("trade", help="halving loop vs trade kernel")
+    sub.add_parser("check", help="do the engines agree?")
+    sub.add_parser("ensemble", help="batched replicates vs looping mkt")
+    sub.add_parser("memory", help="bytes per agent, default vs compact")
+    sub.add_parser("sparse", help="dense vs top-k goods step time")
+    sub.add_parser("parallel", help="step time over worker processes")
+    sub.add_parser("startup", help="interpreter start to first step")
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        engines = ("agent", "vector") if args.engine == "both" else \
+            (args.engine,)
+        run_suite(args.N, args.K, engines, args.steps, args.reps,
+                  args.max_agent_N, args.output)
+    elif args.command == "compare":
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        baseline = None
+        if args.baseline:
+            baseline = []
+            for path in args.baseline:
+                with open(path) as f:
+                    baseline.append(json.load(f))
+        return 1 if compare(old, new, args.threshold, args.floor,
+                            baseline) else 0
+    elif args.command == "engines":
+        compare_engines()
+    elif args.command == "trade":
+        compare_trade()
+    elif args.command == "ensemble":
+        compare_ensemble()
+    elif args.command == "memory":
+        compare_memory()
+    elif args.command == "sparse":
+        compare_sparse()
+    elif args.command == "parallel":
+        compare_parallel()
+    elif args.command == "startup":
+        time_startup()
+    else:
+        check_equivalence()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,45 @@
+"""
+Reading and writing model checkpoints.
+
+A checkpoint is a directory holding meta.json (sizes, flags, step count,
+RNG states) and one .npy file per array (agent state, grid positions,
+ledger tail). Arrays are loaded memory-mapped copy-on-write, so a restore
+only touches the pages the model goes on to change.
+"""
+import json
+import os
+import tempfile
+import numpy as np
+
+
+def write_state(path, meta, arrays):
+    os.makedirs(path, exist_ok=True)
+    for name, values in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), values)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def read_state(path, mmap_mode="c"):
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    arrays = {}
+    for name in os.listdir(path):
+        if name.endswith(".npy"):
+            arrays[name[:-4]] = np.load(os.path.join(path, name),
+                                        mmap_mode=mmap_mode)
+    return meta, arrays
+
+
+def shared_copies(values, n=2):
+    """n copy-on-write copies of values that share one copy's memory
+    until they're written to: private maps of a temporary file. Each
+    page is copied for a map only when that map writes to it."""
+    if values.size == 0:
+        return [values.copy() for _ in range(n)]
+    with tempfile.TemporaryFile() as f:
+        np.ascontiguousarray(values).tofile(f)
+        f.flush()
+        # the maps keep the file alive after it's closed
+        return [np.memmap(f, values.dtype, "c", shape=values.shape)
+                for _ in range(n)]
@@ -0,0 +1,123 @@
+"""
+An array-backed stand-in for Mesa's DataCollector.
+
+    model = mkt(10000, 5, collector="array")
+    # or, with options:
+    model.datacollector = ArrayCollector(model, every=10, sample=1000,
+                                         path="run1", fmt="npy")
+    ...
+    model.datacollector.flush()
+
+Agent values are copied straight out of the model's cached tallies into
+preallocated steps x agents arrays, one row per collected step. With a
+path, each full chunk of rows is written out and the buffer reused, so
+memory stays flat however long the run. The files are
+
+    npy      <path>/<column>_NNNNNN.npy  (np.load(..., mmap_mode="r")),
+             and <path>/AgentID.npy once, as it's the same every chunk
+    npz      <path>/agents_NNNNNN.npz
+    parquet  <path>/agents_NNNNNN.parquet, one row per step and agent
+             (needs pyarrow)
+
+with columns Step, AgentID, Utility and Specialization.
+"""
+import glob
+import os
+import numpy as np
+
+AGENT_VARS = {"Utility": "utility_stats", "Specialization": "spec_stats"}
+
+
+class ArrayCollector():
+    def __init__(self, model, model_reporters=None, rows=1024, every=1,
+                 sample=None, path=None, fmt="npz"):
+        if model_reporters is None:
+            model_reporters = {"Mean_Utility": "mean_utility",
+                               "Mean_Specialization": "mean_specialization"}
+        self.model_reporters = model_reporters
+        self.model_vars = {name: [] for name in model_reporters}
+        self.every = every
+        self.path = path
+        self.fmt = fmt
+        if sample is None:
+            self.ids = np.arange(model.N)
+        else:
+            rng = model.streams.phase("collect")
+            self.ids = np.sort(rng.choice(model.N, sample, replace=False))
+        self.steps = np.zeros(rows, dtype=np.int64)
+        self.data = {name: np.zeros((rows, len(self.ids)))
+                     for name in AGENT_VARS}
+        self.count = 0   # rows filled in the current buffer
+        self.chunks = 0  # chunks written to path
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def collect(self, model):
+        step = model.schedule.steps
+        if step % self.every:
+            return
+        for name, attr in self.model_reporters.items():
+            self.model_vars[name].append(getattr(model, attr))
+        if self.count == len(self.steps):
+            if self.path is None:
+                self._grow()
+            else:
+                self.flush()
+        self.steps[self.count] = step
+        for name, attr in AGENT_VARS.items():
+            self.data[name][self.count] = getattr(model, attr).values[self.ids]
+        self.count += 1
+
+    def _grow(self):
+        rows = 2 * len(self.steps)
+        self.steps = np.resize(self.steps, rows)
+        for name, values in self.data.items():
+            grown = np.zeros((rows, values.shape[1]))
+            grown[:self.count] = values
+            self.data[name] = grown
+
+    def view(self, name):
+        """Steps x agents array of `name` for the rows still in memory.
+        A view, not a copy, so it changes as collection goes on."""
+        return self.data[name][:self.count]
+
+    def flush(self):
+        """Write the buffered rows to path and start a new chunk"""
+        if self.path is None or self.count == 0:
+            return
+        stem = os.path.join(self.path, "%s_%06d")
+        if self.fmt == "npy":
+            if self.chunks == 0:
+                np.save(os.path.join(self.path, "AgentID.npy"), self.ids)
+            np.save(stem % ("Step", self.chunks), self.steps[:self.count])
+            for name in self.data:
+                np.save(stem % (name, self.chunks), self.view(name))
+        elif self.fmt == "npz":
+            np.savez(stem % ("agents", self.chunks) + ".npz",
+                     Step=self.steps[:self.count], AgentID=self.ids,
+                     **{name: self.view(name) for name in self.data})
+        elif self.fmt == "parquet":
+            self.get_agent_vars_dataframe().reset_index().to_parquet(
+                stem % ("agents", self.chunks) + ".parquet")
+        else:
+            raise ValueError("unknown format %r" % self.fmt)
+        self.chunks += 1
+        self.count = 0
+
+    def get_model_vars_dataframe(self):
+        import pandas as pd  # only needed here; slow to import
+        return pd.DataFrame(self.model_vars)
+
+    def get_agent_vars_dataframe(self):
+        """The rows still in memory, indexed like Mesa's (Step, AgentID)"""
+        import pandas as pd
+        index = pd.MultiIndex.from_product(
+            [self.steps[:self.count], self.ids], names=["Step", "AgentID"])
+        return pd.DataFrame({name: self.view(name).ravel()
+                             for name in self.data}, index=index)
+
+
+def load_chunks(path, name, mmap_mode="r"):
+    """Memory-map every .npy chunk of column `name` written to path"""
+    files = sorted(glob.glob(os.path.join(path, name + "_*.npy")))
+    return [np.load(f, mmap_mode=mmap_mode) for f in files]
@@ -0,0 +1 @@
+# Lets pytest import the repo's modules from tests/ however it's started
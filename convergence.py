@@ -0,0 +1,108 @@
+"""
+Stop a run once the economy has settled down.
+
+    model = mkt(500, 3, vectorized=True)
+    model.convergence = Convergence(tolerance=1e-3, window=50, patience=3)
+    while model.running:
+        model.step()
+    model.converged_step
+
+Steps are taken in windows, and each watched quantity's mean and variance
+over the current window are accumulated as it goes. Nothing is kept from
+earlier steps but the last window's mean and variance and the previous
+production plans, so the cost is the same on step 10 as on step 100000.
+"""
+import numpy as np
+
+WATCH = ("specialization", "utility", "plan")
+
+
+class Convergence():
+    """Watches, each step,
+
+        specialization  model.mean_specialization
+        utility         model.mean_utility
+        plan            the mean absolute change in prod_plan
+
+    At the end of every `window` steps a window is calm if the mean of
+    specialization and of utility is within `tolerance` (relative) of the
+    last window's, or within two standard errors of it, so that the
+    noise consumption adds doesn't count as change; and if prod_plan moved
+    by less than `tolerance` a step on average. After `patience` calm
+    windows in a row the run is stationary: model.running is set False
+    and model.converged_step is the first step of the first calm window.
+
+    Without consumption endowments pile up and utility grows without end,
+    so watch=("specialization", "plan") is the one to use there.
+    """
+    def __init__(self, tolerance=1e-3, window=50, patience=3, watch=WATCH):
+        self.tolerance = tolerance
+        self.window = window
+        self.patience = patience
+        self.watch = watch
+        self.sums = dict.fromkeys(watch, 0.)
+        self.squares = dict.fromkeys(watch, 0.)
+        self.count = 0
+        self.previous = None  # last window's {name: (mean, var)}
+        self.plan = None
+        self.calm = 0  # calm windows in a row
+        self.calm_since = None
+
+    def values(self, model):
+        values = {"specialization": model.mean_specialization,
+                  "utility": model.mean_utility}
+        if "plan" in self.watch:
+            plan = np.array(model.prod_plan if model.vectorized
+                            else [a.prod_plan for a in model.ants])
+            # nothing to compare the first step with; the first window is
+            # never calm anyway
+            values["plan"] = (0. if self.plan is None
+                              else np.abs(plan - self.plan).mean())
+            self.plan = plan
+        return values
+
+    def update(self, model):
+        """Take in the model's state after a step; returns True once the
+        model is stationary"""
+        values = self.values(model)
+        for name in self.watch:
+            self.sums[name] += values[name]
+            self.squares[name] += values[name] ** 2
+        self.count += 1
+        if self.count < self.window:
+            return False
+        n = self.count
+        stats = {name: (self.sums[name] / n,
+                        max(self.squares[name] / n -
+                            (self.sums[name] / n) ** 2, 0.))
+                 for name in self.watch}
+        if self.is_calm(stats):
+            if self.calm == 0:
+                self.calm_since = model.schedule.steps - n + 1
+            self.calm += 1
+        else:
+            self.calm = 0
+        self.previous = stats
+        self.sums = dict.fromkeys(self.watch, 0.)
+        self.squares = dict.fromkeys(self.watch, 0.)
+        self.count = 0
+        if self.calm >= self.patience:
+            model.running = False
+            model.converged_step = self.calm_since
+            return True
+        return False
+
+    def is_calm(self, stats):
+        if self.previous is None:
+            return False
+        for name, (mean, var) in stats.items():
+            if name == "plan":
+                if mean >= self.tolerance:
+                    return False
+                continue
+            old_mean, old_var = self.previous[name]
+            noise = 2 * np.sqrt((var + old_var) / self.window)
+            if abs(mean - old_mean) > max(self.tolerance * abs(old_mean),
+                                          noise):
+                return False
+        return True
@@ -0,0 +1,119 @@
+"""
+Many small replicate economies stepped together.
+
+    from ensemble import Ensemble
+    runs = Ensemble(200, 50, 2, seed=1)
+    series = runs.run(100)
+    series["Mean_Utility"]  # 200 x 100, one row per replicate
+
+Agent state is held as M x N x K arrays (M replicates of N agents and K
+goods). Every phase runs the kernels over all M * N agents at once, so the
+Python overhead of a step is paid once for the whole ensemble rather than
+once per replicate. Trading partners are always drawn from the same
+replicate, so the replicates never interact.
+
+Each replicate follows the same rules as mkt(N, K, vectorized=True), but
+the random draws differ, so replicate r is not the same run as any
+single mkt.
+"""
+import numpy as np
+import kernels
+from streams import Streams
+
+
+class Ensemble():
+    def __init__(self, M, N, K, width=10, height=10, trade=True,
+                 seed=None, local=None):
+        self.streams = Streams(seed)
+        self.M = M
+        self.N = N
+        self.K = K
+        self.width = width
+        self.height = height
+        self.consume = False
+        self.units = 5
+        self.trade = trade
+        self.solo_update = True
+        self.self_trade = False
+        self.local = local
+        self.steps = 0
+        draws = self.streams.rows("init").integers(1, 4, (M * N, 2, K))
+        self.ppf = draws[:, 0].astype(float).reshape(M, N, K)
+        self.endowment = 10. * self.ppf
+        self.prod_plan = np.full((M, N, K), 1. / K)
+        u_params = draws[:, 1].reshape(M, N, K)
+        self.u_params = u_params / u_params.sum(axis=-1, keepdims=True)
+        self.learning_rate = np.full((M, N), 0.05)
+        place = self.streams.rows("place")
+        self.pos = place.integers(0, [width, height], (M * N, 2)).reshape(
+            M, N, 2)
+        # first agent of each agent's replicate, for matching
+        self._offset = np.repeat(np.arange(M) * N, N)
+
+    def _flat(self, name):
+        """(M * N) x ... view of one of the agent arrays"""
+        values = getattr(self, name)
+        return values.reshape((self.M * self.N,) + values.shape[2:])
+
+    def match(self, rng):
+        """A partner for every agent from its own replicate: a random
+        cycle per replicate (or any permutation with self_trade), or a
+        neighbour on the grid with `local` set, as in mkt."""
+        M, N = self.M, self.N
+        if self.local:
+            groups, n_groups = kernels.trade_groups(
+                self._flat("pos"), self.width, self.height, self.local, rng)
+            return kernels.local_match(
+                self._offset // N * n_groups + groups, M * n_groups, rng)
+        if self.self_trade or N < 2:
+            return self._offset + np.argsort(rng.random((M, N)),
+                                             axis=1).ravel()
+        # every agent trades with the next one in a shuffled order,
+        # wrapping around within its replicate
+        order = np.argsort(rng.random((M, N)), axis=1) + \
+            self._offset.reshape(M, N)
+        partner = np.empty(M * N, dtype=order.dtype)
+        partner[order] = np.roll(order, -1, axis=1)
+        return partner
+
+    def step(self):
+        """Step every agent of every replicate once"""
+        step = self.steps
+        endowment = self._flat("endowment")
+        prod_plan = self._flat("prod_plan")
+        ppf = self._flat("ppf")
+        u_params = self._flat("u_params")
+        learning_rate = self._flat("learning_rate")
+        kernels.move(self._flat("pos"), self.width, self.height,
+                     self.streams.rows("move", step))
+        kernels.produce(endowment, prod_plan, ppf)
+        if self.trade:
+            partner = self.match(self.streams.phase("match", step))
+            kernels.trade(endowment, prod_plan, ppf, learning_rate,
+                          partner=partner)
+        if self.consume:
+            kernels.consume(endowment, u_params, self.units,
+                            self.streams.rows("consume", step))
+        if self.solo_update:
+            kernels.solo_update(prod_plan, u_params, learning_rate)
+        self.steps += 1
+
+    @property
+    def mean_utility(self):
+        """Mean utility of each replicate"""
+        return kernels.utility(self.endowment, self.u_params).mean(axis=1)
+
+    @property
+    def mean_specialization(self):
+        return kernels.specialization(self.prod_plan).mean(axis=1)
+
+    def run(self, steps):
+        """Step `steps` times and return the per-replicate model series
+        as M x steps arrays"""
+        series = {"Mean_Utility": np.empty((self.M, steps)),
+                  "Mean_Specialization": np.empty((self.M, steps))}
+        for t in range(steps):
+            self.step()
+            series["Mean_Utility"][:, t] = self.mean_utility
+            series["Mean_Specialization"][:, t] = self.mean_specialization
+        return series
@@ -0,0 +1,130 @@
+"""
+Run mkt without a browser, from a config file.
+
+    python -m headless run.json
+    python -m headless run.json --steps 50 --output runs/b
+
+run.json holds mkt's arguments and the run's own settings, e.g.
+
+    {"N": 10000, "K": 5, "seed": 1, "vectorized": true,
+     "trade": true, "consume": true, "solo_update": true,
+     "steps": 1000, "output": "runs/a"}
+
+and may also set anything else sweep.build takes (the rest of mkt's
+arguments, the model's flags and learning_rate), "converge" (keyword
+arguments of convergence.Convergence) and "agents": true to keep every
+agent's utility and specialization in a store.ResultStore. Unless
+ledger_size is set, the ledger keeps only the last step's trades, as
+nothing here reads it. Everything goes in the output directory:
+
+    series.csv    step, Mean_Utility, Mean_Specialization
+    summary.json  the config, steps run, converged_step and timings
+    agents/       the ResultStore, with "agents": true
+
+Only what a run needs is imported: no pandas, and none of Mesa's
+visualization or Tornado. summary.json records the seconds from the start
+of the process to the end of the first step, and the import and setup
+times that make it up.
+"""
+import argparse
+import json
+import os
+import time
+
+# Config keys used by run() itself; the rest are sweep.build's params
+RUN = ("steps", "output", "converge", "agents")
+DEFAULTS = {"N": 1000, "K": 2, "steps": 100, "output": "output"}
+
+
+def since_process_start():
+    """Seconds since this process started, from /proc (Linux only)"""
+    try:
+        with open("/proc/self/stat") as f:
+            start = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start / os.sysconf("SC_CLK_TCK")
+
+
+def read_config(path, **overrides):
+    """The config file's settings over DEFAULTS, with `overrides` that
+    aren't None over those. Unknown keys are left for sweep.build to
+    reject."""
+    with open(path) as f:
+        config = dict(DEFAULTS, **json.load(f))
+    config.update({k: v for k, v in overrides.items() if v is not None})
+    return config
+
+
+def run(config):
+    """Run the model `config` describes and write its outputs; returns the
+    summary"""
+    timings = {}
+    start = time.perf_counter()
+    import numpy as np
+    from sweep import bounded, build
+    timings["import"] = time.perf_counter() - start
+    start = time.perf_counter()
+    model = build(bounded({k: v for k, v in config.items()
+                           if k not in RUN}), config.get("converge"))
+    output = config["output"]
+    os.makedirs(output, exist_ok=True)
+    if config.get("agents"):
+        from store import ResultStore
+        model.datacollector = ResultStore(
+            os.path.join(output, "agents"), model,
+            params={k: v for k, v in config.items() if k not in RUN})
+        advance = model.step
+    else:
+        advance = model.advance
+    timings["setup"] = time.perf_counter() - start
+    steps = config["steps"]
+    series = np.empty((steps, 3))
+    start = time.perf_counter()
+    t = 0
+    while t < steps and model.running:
+        advance()
+        series[t] = (model.schedule.steps, model.mean_utility,
+                     model.mean_specialization)
+        t += 1
+        if t == 1:
+            timings["first_step"] = time.perf_counter() - start
+            timings["to_first_step"] = since_process_start()
+    timings["run"] = time.perf_counter() - start
+    if config.get("agents"):
+        model.datacollector.close()
+    np.savetxt(os.path.join(output, "series.csv"), series[:t],
+               delimiter=",", fmt=("%d", "%.17g", "%.17g"),
+               header="step,Mean_Utility,Mean_Specialization", comments="")
+    summary = {"config": config, "steps": t,
+               "converged_step": model.converged_step, "seconds": timings}
+    with open(os.path.join(output, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=1)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m headless", description="Run mkt from a config file")
+    parser.add_argument("config", help="JSON file of settings")
+    parser.add_argument("--steps", type=int)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", help="directory for the outputs")
+    parser.add_argument("-q", "--quiet", action="store_true")
+    args = parser.parse_args(argv)
+    config = read_config(args.config, steps=args.steps, seed=args.seed,
+                         output=args.output)
+    summary = run(config)
+    if not args.quiet:
+        seconds = summary["seconds"]
+        print("%d steps in %.2fs, first step %.3fs after process start "
+              "(imports %.3fs), outputs in %s"
+              % (summary["steps"], seconds["run"],
+                 seconds["to_first_step"] or float("nan"),
+                 seconds["import"], config["output"]))
+
+
+if __name__ == "__main__":
+    main()
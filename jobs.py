@@ -0,0 +1,291 @@
+"""
+A local HTTP/JSON service for pushing many mkt runs through one
+long-lived process.
+
+    python run.py --jobs --workers 4
+
+    POST   /runs              submit a run. The body is JSON, e.g.
+                              {"params": {"N": 500, "K": 3, "seed": 1,
+                                          "consume": true},
+                               "steps": 1000,
+                               "converge": {"tolerance": 1e-3}}
+    GET    /runs              every run's status
+    GET    /runs/<id>         one run's status and progress
+    GET    /runs/<id>/result  the run's series as JSON lines, one per
+                              chunk of steps, streamed as the run makes
+                              them and ending when the run does
+    DELETE /runs/<id>         cancel a queued or running run, or forget a
+                              finished one
+
+params are as for sweep.build (N and K are required; ledger_spill and
+collector can't be set), and converge as for sweep.run_one. Nothing
+here reads a run's ledger, so unless params set ledger_size it keeps only
+the last step's trades. Runs wait in a queue of at most max_queued (503
+beyond that) and go to the first of `workers` worker processes to come
+free. The workers are started once and run one model after another, so a
+run costs no interpreter start-up. A run is queued, running, done, failed
+or cancelled; a running run that is cancelled stops before its next step.
+"""
+import json
+import os
+import threading
+from collections import deque
+from multiprocessing import get_context
+import tornado.ioloop
+import tornado.iostream
+import tornado.locks
+import tornado.web
+from sweep import PARAMS as BUILD_PARAMS, SERIES, bounded, build
+
+# What a run's params may set: what sweep.build takes, but nothing that
+# writes files (ledger_spill) or only matters to step() (collector)
+PARAMS = tuple(name for name in BUILD_PARAMS
+               if name not in ("ledger_spill", "collector", "running"))
+FINISHED = ("done", "failed", "cancelled")
+
+
+class Run():
+    def __init__(self, run_id, params, steps, converge):
+        self.id = run_id
+        self.params = params
+        self.steps = steps
+        self.converge = converge
+        self.state = "queued"
+        self.step = 0
+        self.converged_step = None
+        self.error = None
+        self.worker = None
+        self.chunks = []
+        self.changed = tornado.locks.Condition()
+
+    @property
+    def finished(self):
+        return self.state in FINISHED
+
+    def status(self):
+        return {"id": self.id, "status": self.state, "step": self.step,
+                "steps": self.steps, "params": self.params,
+                "converged_step": self.converged_step, "error": self.error,
+                "chunks": len(self.chunks)}
+
+
+class Jobs():
+    """The runs, the queue and the worker processes. Everything but the
+    thread reading the workers' messages runs on the IOLoop."""
+    def __init__(self, workers=None, max_queued=1000, chunk=100):
+        workers = workers or os.cpu_count()
+        self.max_queued = max_queued
+        self.runs = {}
+        self.queue = deque()
+        self.idle = list(range(workers))
+        self.next_id = 1
+        context = get_context("spawn")
+        self.events = context.Queue()
+        # per worker, the id of a run it should stop (0 for none)
+        self.stop = context.Array("q", workers)
+        self.tasks = []
+        self.processes = []
+        for worker in range(workers):
+            tasks = context.Queue()
+            process = context.Process(
+                target=_work,
+                args=(worker, tasks, self.events, self.stop, chunk),
+                daemon=True)
+            process.start()
+            self.tasks.append(tasks)
+            self.processes.append(process)
+
+    def start(self):
+        """Start passing the workers' messages to the current IOLoop"""
+        loop = tornado.ioloop.IOLoop.current()
+
+        def listen():
+            while True:
+                event = self.events.get()
+                if event is None:
+                    return
+                loop.add_callback(self.on_event, *event)
+        self.listener = threading.Thread(target=listen, daemon=True)
+        self.listener.start()
+
+    def submit(self, params, steps, converge=None):
+        if not isinstance(params, dict) or set(params) - set(PARAMS):
+            raise ValueError("params may only set %s" % ", ".join(PARAMS))
+        if "N" not in params or "K" not in params:
+            raise ValueError("params must set N and K")
+        if not isinstance(steps, int) or steps < 1:
+            raise ValueError("steps must be a positive integer")
+        if converge is not None and not isinstance(converge, dict):
+            raise ValueError("converge must be an object")
+        if len(self.queue) >= self.max_queued:
+            raise OverflowError("the queue is full")
+        run = Run(self.next_id, params, steps, converge)
+        self.next_id += 1
+        self.runs[run.id] = run
+        self.queue.append(run)
+        self.dispatch()
+        return run
+
+    def dispatch(self):
+        """Hand queued runs to idle workers"""
+        while self.queue and self.idle:
+            run = self.queue.popleft()
+            run.worker = self.idle.pop()
+            run.state = "running"
+            self.tasks[run.worker].put(
+                (run.id, run.params, run.steps, run.converge))
+
+    def cancel(self, run):
+        if run.state == "queued":
+            self.queue.remove(run)
+            self.finish(run, "cancelled")
+        elif run.state == "running":
+            self.stop[run.worker] = run.id
+
+    def forget(self, run):
+        del self.runs[run.id]
+
+    def finish(self, run, state):
+        run.state = state
+        run.changed.notify_all()
+
+    def on_event(self, kind, run_id, *data):
+        run = self.runs.get(run_id)
+        if kind == "end":
+            state, detail, worker = data
+            self.idle.append(worker)
+            self.dispatch()
+            if run is None:
+                return
+            if state == "failed":
+                run.error = detail
+            else:
+                run.converged_step = detail
+            self.finish(run, state)
+        elif run is not None:  # a chunk
+            chunk, = data
+            run.chunks.append(chunk)
+            run.step = chunk["step"][-1]
+            run.changed.notify_all()
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join()
+        self.events.put(None)
+
+
+def _work(worker, tasks, events, stop, chunk):
+    """A worker process: run models one after another, sending their
+    series back `chunk` steps at a time"""
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        run_id, params, steps, converge = task
+        series = {name: [] for name in ("step",) + SERIES}
+        try:
+            model = build(bounded(params), converge)
+            state = "done"
+            while model.schedule.steps < steps and model.running:
+                if stop[worker] == run_id:
+                    state = "cancelled"
+                    break
+                model.advance()
+                series["step"].append(model.schedule.steps)
+                series["Mean_Utility"].append(float(model.mean_utility))
+                series["Mean_Specialization"].append(
+                    float(model.mean_specialization))
+                if len(series["step"]) == chunk:
+                    events.put(("chunk", run_id, series))
+                    series = {name: [] for name in series}
+            if series["step"]:
+                events.put(("chunk", run_id, series))
+            events.put(("end", run_id, state, model.converged_step, worker))
+        except Exception as error:
+            events.put(("end", run_id, "failed", repr(error), worker))
+
+
+class Handler(tornado.web.RequestHandler):
+    def initialize(self, jobs):
+        self.jobs = jobs
+
+    def lookup(self, run_id):
+        run = self.jobs.runs.get(int(run_id))
+        if run is None:
+            raise tornado.web.HTTPError(404, reason="no such run")
+        return run
+
+    def write_error(self, status_code, **kwargs):
+        self.finish({"error": self._reason})
+
+
+class Runs(Handler):
+    def get(self):
+        self.write({"runs": [run.status() for run in self.jobs.runs.values()]})
+
+    def post(self):
+        try:
+            body = json.loads(self.request.body or b"{}")
+            run = self.jobs.submit(body.get("params", {}),
+                                   body.get("steps", 100),
+                                   body.get("converge"))
+        except OverflowError as error:
+            raise tornado.web.HTTPError(503, reason=str(error))
+        except (ValueError, AttributeError) as error:
+            raise tornado.web.HTTPError(400, reason=str(error))
+        self.set_status(201)
+        self.write(run.status())
+
+
+class RunStatus(Handler):
+    def get(self, run_id):
+        self.write(self.lookup(run_id).status())
+
+    def delete(self, run_id):
+        run = self.lookup(run_id)
+        if run.finished:
+            self.jobs.forget(run)
+        else:
+            self.jobs.cancel(run)
+        self.write(run.status())
+
+
+class Result(Handler):
+    async def get(self, run_id):
+        run = self.lookup(run_id)
+        self.set_header("Content-Type", "application/x-ndjson")
+        sent = 0
+        while True:
+            for chunk in run.chunks[sent:]:
+                self.write(json.dumps(chunk) + "\n")
+            sent = len(run.chunks)
+            try:
+                await self.flush()
+            except tornado.iostream.StreamClosedError:
+                return  # the client went away
+            if run.finished:
+                return
+            await run.changed.wait()
+
+
+def make_app(jobs):
+    args = {"jobs": jobs}
+    return tornado.web.Application([
+        (r"/runs", Runs, args),
+        (r"/runs/(\d+)", RunStatus, args),
+        (r"/runs/(\d+)/result", Result, args)])
+
+
+def serve(port=8523, workers=None, max_queued=1000, chunk=100):
+    """Serve the job API until interrupted"""
+    jobs = Jobs(workers, max_queued, chunk)
+    # the API has no authentication, so it only listens locally
+    make_app(jobs).listen(port, address="127.0.0.1")
+    jobs.start()
+    print("Serving on http://127.0.0.1:%d" % port)
+    try:
+        tornado.ioloop.IOLoop.current().start()
+    finally:
+        jobs.close()
@@ -0,0 +1,309 @@
+"""
+Batched versions of the agent phases in model.py.
+
+Every function works on the model-owned agent arrays (one row per agent,
+one column per good) and updates them in place, so a whole population is
+stepped with a handful of NumPy operations instead of one Python call per
+agent. Kernels that draw random numbers take an `rng` with the Generator
+interface (see streams.py) and fall back on the global np.random.
+"""
+import numpy as np
+
+
+def utility(endowment, u_params):
+    """Utility of every agent, as in ant.utility"""
+    return (endowment ** u_params).sum(axis=-1)
+
+
+def specialization(prod_plan):
+    """Share of each agent's time spent on their most popular good"""
+    return prod_plan.max(axis=-1) / prod_plan.sum(axis=-1)
+
+
+def produce(endowment, prod_plan, ppf):
+    """Add one day's production to every endowment"""
+    endowment += prod_plan * ppf
+
+
+def solo_update(prod_plan, u_params, learning_rate):
+    """Nudge every production plan towards preferred goods"""
+    delta = u_params / u_params.min(axis=-1, keepdims=True)
+    prod_plan += delta * learning_rate[..., None]
+    prod_plan /= prod_plan.sum(axis=-1, keepdims=True)
+
+
+def consume(endowment, u_params, units=5, rng=np.random):
+    """Use up goods based on weighted probability.
+
+    All units for all agents are drawn in one categorical sampling pass
+    over the rows of u_params, then tallied per good. Each good is clipped
+    so nobody eats what they don't have. Returns the amounts eaten.
+    """
+    N, K = endowment.shape
+    cdf = u_params.cumsum(axis=-1)
+    u = rng.random((N, units, 1)) * cdf[:, None, -1:]
+    eat = (u > cdf[:, None, :]).sum(axis=-1)
+    eat += np.arange(N)[:, None] * K
+    counts = np.bincount(eat.ravel(), minlength=N * K).reshape(N, K)
+    # Don't risk going negative
+    eaten = np.minimum(counts, endowment.clip(0))
+    endowment -= eaten
+    return eaten
+
+
+def match(n, self_trade=True, rng=np.random):
+    """Pick a partner for every agent as a random permutation, so each agent
+    starts exactly one trade and is the partner in exactly one other.
+    With self_trade=False the permutation is a single random cycle, which
+    never maps an agent to itself."""
+    if self_trade or n < 2:
+        return rng.permutation(n)
+    order = rng.permutation(n)
+    partner = np.empty(n, dtype=order.dtype)
+    partner[order] = np.roll(order, -1)
+    return partner
+
+
+def cell_index(cells, n_cells):
+    """Agents sorted by cell id, and where each cell's run of agents
+    starts in that order (cell c holds order[start[c]:start[c + 1]]).
+    NumPy's stable sort of 16 bit integers is a radix sort, so this sorts
+    by the low 16 bits of the cell id and then, if there are more than
+    65536 cells, stably by the next 16: linear in the number of agents
+    for up to 2 ** 32 cells."""
+    counts = np.bincount(cells, minlength=n_cells)
+    start = np.zeros(n_cells + 1, dtype=np.int64)
+    np.cumsum(counts, out=start[1:])
+    order = np.argsort(cells.astype(np.uint16), kind="stable")
+    if n_cells > 1 << 16:
+        if n_cells > 1 << 32:
+            raise ValueError("more than 2 ** 32 cells")
+        high = (cells[order] >> 16).astype(np.uint16)
+        order = order[np.argsort(high, kind="stable")]
+    return order, start
+
+
+def trade_groups(pos, width, height, local, rng=np.random):
+    """Group id of every agent for local trading, and the number of
+    groups. "cell" trades within a grid cell. "block" trades within
+    2 x 2 blocks of cells whose offset is redrawn every call, so any two
+    neighbouring cells can end up in the same block. (The per-agent
+    engine's "neighbors", the whole Moore neighbourhood, can't be a
+    partition into groups, so there's no vectorized version of it.)"""
+    x, y = pos[:, 0], pos[:, 1]
+    if local == "cell":
+        return x * height + y, width * height
+    if local != "block":
+        raise ValueError("local trading is by \"cell\" or \"block\" in "
+                         "the vectorized engine, not %r" % (local,))
+    ox, oy = rng.integers(0, 2, 2)
+    rows = (height + 1) // 2
+    groups = (x + ox) % width // 2 * rows + (y + oy) % height // 2
+    return groups, (width + 1) // 2 * rows
+
+
+def local_match(groups, n_groups, rng=np.random):
+    """Like match, but every agent's partner comes from its own group
+    (e.g. its grid cell). Agents are shuffled, sorted by group, and each
+    trades with the next agent in its group, wrapping around. An agent
+    alone in its group is its own partner, which is a no-op trade."""
+    shuffled = rng.permutation(len(groups))
+    order, start = cell_index(groups[shuffled], n_groups)
+    order = shuffled[order]
+    group = groups[order]
+    first = start[group]
+    size = start[group + 1] - first
+    nxt = first + (np.arange(len(order)) - first + 1) % size
+    partner = np.empty(len(order), dtype=order.dtype)
+    partner[order] = order[nxt]
+    return partner
+
+
+# Moore neighbourhood, without staying put
+MOORE = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                  if dx or dy])
+
+
+def move(pos, width, height, rng=np.random):
+    """Every agent takes one random Moore step on a torus"""
+    pos += MOORE[(rng.random((len(pos),)) * len(MOORE)).astype(int)]
+    pos %= (width, height)
+
+
+def quotes(endowment, prod_plan, ppf, u_params, margin=0.05):
+    """Money mode bids and asks for goods 1..K-1, priced in good 0.
+
+    An agent asks `margin` over its ant.prices (ppf[0] / ppf), what a unit
+    of the good costs it in good 0 it could have made instead, and bids
+    `margin` under its marginal rate of substitution for good 0 (the ratio
+    of marginal utilities of ant.utility), what a unit is worth to it. So
+    a fill goes from an agent that makes the good cheaply to one that
+    values it more. It offers up to one day's production of a good and
+    bids with up to one day's production of good 0 split evenly over the
+    other goods, in both cases no more than half what it holds, as in
+    trade(). Returns (bid, ask, bid_size, ask_size), each N x K-1; sizes
+    are in units of the good.
+    """
+    K = endowment.shape[1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        marginal = u_params * endowment ** (u_params - 1)
+        value = marginal[:, 1:] / marginal[:, :1]
+        ok = np.isfinite(value) & (value > 0)
+        value = np.where(ok, value, 1.)
+        bid = value / (1 + margin)
+        ask = ppf[:, :1] / ppf[:, 1:] * (1 + margin)
+        day = prod_plan * ppf
+        ask_size = np.minimum(day[:, 1:], endowment[:, 1:] / 2)
+        budget = np.minimum(day[:, :1], endowment[:, :1] / 2) / (K - 1)
+        bid_size = budget / bid
+    selling = np.isfinite(ask) & (ask > 0)
+    ask = np.where(selling, ask, 1.)
+    ask_size = np.where(selling, ask_size.clip(0), 0.)
+    bid_size = np.where(ok, bid_size.clip(0), 0.)
+    return bid, ask, bid_size, ask_size
+
+
+def has(endowment, goods):
+    """Row-wise ant.has"""
+    return (endowment > goods).all(axis=-1)
+
+
+def halvings(endowment, goods):
+    """How many times goods must be halved before endowment > goods,
+    worked out from log2 of the ratio rather than by halving."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n = np.floor(np.log2(goods / endowment)) + 1
+    # goods <= 0 put no lower bound on the halvings; a nonpositive
+    # endowment is caught by the feasibility check in feasible_scale
+    n[~((goods > 0) & (endowment > 0))] = 0
+    return np.clip(n, 0, None).max(axis=-1)
+
+
+def feasible_scale(endowment0, give, endowment1, take):
+    """Closed form of the exchange.day_trade halving loop: the largest
+    2 ** -n such that endowment0 > give * 2 ** -n and
+    endowment1 > take * 2 ** -n, or 0 where no halving makes the trade
+    affordable (the loop would never end)."""
+    n = np.maximum(halvings(endowment0, give), halvings(endowment1, take))
+    scale = np.ldexp(1., -n.astype(int))
+    for _ in range(2):
+        # log2 can round the wrong way right at a power of two
+        ok = (has(endowment0, give * scale[..., None]) &
+              has(endowment1, take * scale[..., None]))
+        scale = np.where(ok, scale, scale / 2)
+    return np.where(ok, scale, 0.)
+
+
+def trade(endowment, prod_plan, ppf, learning_rate, self_trade=False,
+          learn=False, ledger=None, step=0, rng=np.random, partner=None):
+    """Batched exchange.day_trade + exchange.undertake for the whole
+    population at once.
+
+    Every agent starts one trade with its `partner`, a permutation from
+    match() or local_match() (match() is used if none is given). Each
+    agent is on both ends of a trade, so each side of a trade is sized
+    against half of that agent's endowment, which keeps the pair of trades
+    affordable together. Partners are a permutation, so the updates are
+    scattered back with plain fancy indexing.
+
+    exchange.undertake works out its delta before day_trade fills in the
+    goods, so in the per-agent path trades never move prod_plan. learn=True
+    applies the update undertake means to make.
+
+    Completed trades are recorded in `ledger` if one is given. Returns
+    each trade's scale, 2 ** -n after n halvings or 0 if unaffordable.
+    """
+    a = np.arange(len(endowment))
+    b = partner if partner is not None else match(len(endowment),
+                                                  self_trade, rng)
+    give = prod_plan * ppf
+    take = give[b]
+    scale = feasible_scale(endowment / 2, give, endowment[b] / 2, take)
+    give *= scale[:, None]
+    take *= scale[:, None]
+    delta = give - take
+    endowment -= delta
+    endowment[b] += delta
+    if learn:
+        prod_plan += delta * learning_rate[:, None]
+        prod_plan[b] -= delta * learning_rate[b, None]
+    if ledger is not None:
+        done = (scale > 0) & (a != b)
+        ledger.extend(step, a[done], b[done], give[done], take[done])
+    return scale
+
+
+# Sparse goods: with model.top_k set, each agent only makes and values
+# its own k of the K goods. Row i of every agent array then holds the
+# values for goods[i] (sorted), and goods outside an agent's set are
+# neither held, produced, valued nor accepted in trade. produce, consume,
+# solo_update and specialization work on these N x k arrays unchanged;
+# utility and trade need to know which goods the columns are.
+
+
+def draw_goods(N, K, k, rngs):
+    """A sorted set of k distinct goods out of K for each of N agents.
+    `rngs` is an iterator of generators, a fresh one for each attempt;
+    rows that drew a repeat are drawn again from the next, so the work
+    is O(N * k) unless k is a large share of K."""
+    if k == K:
+        return np.broadcast_to(np.arange(K), (N, K)).copy()
+    if 4 * k > K:
+        keys = next(rngs).random((N, K))
+        return np.sort(np.argpartition(keys, k - 1, axis=1)[:, :k], axis=1)
+    goods = np.sort(next(rngs).integers(0, K, (N, k)), axis=1)
+    while True:
+        again = (np.diff(goods, axis=1) == 0).any(axis=1)
+        if not again.any():
+            return goods
+        redraw = next(rngs).integers(0, K, (N, k))
+        goods[again] = np.sort(redraw[again], axis=1)
+
+
+def sparse_utility(endowment, u_params, K):
+    """ant.utility of the dense vectors: every good an agent doesn't
+    value adds 0 ** 0 = 1"""
+    return utility(endowment, u_params) + (K - endowment.shape[1])
+
+
+def good_positions(goods, K, rows, wanted):
+    """Column of good wanted[i, j] in row rows[i] of goods, or -1 if
+    that agent doesn't have it"""
+    k = goods.shape[1]
+    keys = (np.arange(len(goods))[:, None] * K + goods).ravel()
+    query = rows[:, None] * K + wanted
+    found = np.searchsorted(keys, query).clip(0, len(keys) - 1)
+    pos = found - rows[:, None] * k
+    pos[keys[found] != query] = -1
+    return pos
+
+
+def sparse_trade(goods, K, endowment, prod_plan, ppf, partner):
+    """trade() for sparse goods. Each agent offers its day's production of
+    the goods its partner has, and each side is sized against half its
+    endowment as in trade(). Returns each trade's scale. Completed trades
+    are not recorded, since a ledger row is K goods wide."""
+    N, k = endowment.shape
+    a = np.arange(N)
+    b = partner
+    to_b = good_positions(goods, K, b, goods)      # a's goods in b's row
+    to_a = good_positions(goods, K, a, goods[b])   # b's goods in a's row
+    day = prod_plan * ppf
+    give = day.copy()
+    give[to_b < 0] = 0
+    take = day[b]  # b's goods, in b's columns
+    take[to_a < 0] = 0
+    scale = feasible_scale(endowment / 2, give, endowment[b] / 2, take)
+    give *= scale[:, None]
+    take *= scale[:, None]
+    # what each side receives, in its own columns (row i is the trade
+    # agent i started, as for give and take)
+    got = np.zeros_like(endowment)
+    rows, cols = np.nonzero(to_a >= 0)
+    got[rows, to_a[rows, cols]] = take[rows, cols]
+    got_b = np.zeros_like(endowment)
+    rows, cols = np.nonzero(to_b >= 0)
+    got_b[rows, to_b[rows, cols]] = give[rows, cols]
+    endowment -= give - got
+    endowment[b] += got_b - take
+    return scale
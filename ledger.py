@@ -0,0 +1,299 @@
+"""
+A columnar record of completed trades.
+"""
+import os
+import numpy as np
+
+
+class TradeLedger():
+    """Trades stored as preallocated columns rather than exchange objects.
+
+    capacity=None keeps every trade in memory (the columns double when
+    full); capacity=M keeps only the last M trades in a ring buffer. If
+    spill is a directory, every `chunk` trades are also written there as
+    a trades_NNNNNN.npz segment so nothing is lost when the ring wraps.
+
+    Three indexes are kept up to date as trades come in, so the queries
+    below cost the same however long the run:
+
+    - last / prev: for each agent, the number of its last trade (as
+      either party), and for each trade, the number of each party's trade
+      before it. Following the chain back from last gives all of an
+      agent's trades still in memory (trades_of), in time proportional to
+      how many there are;
+    - recent: for each agent, the numbers of its last `recent` trades, in
+      a ring of its own (recent_of);
+    - pair_trade / pair_price: for each pair of goods (i, j), the number
+      of the last trade in which the initiator gave i and took j, and the
+      units of j it took per unit of i.
+    """
+    def __init__(self, K, capacity=None, spill=None, chunk=4096, recent=16):
+        self.K = K
+        self.capacity = capacity
+        self.spill = spill
+        self.chunk = chunk if capacity is None else min(chunk, capacity)
+        self.count = 0    # trades recorded so far
+        self.spilled = 0  # trades already written to disk
+        # number of the trade in row 0 of an unbounded ledger's columns;
+        # not 0 once restored from a checkpoint's tail
+        self.base = 0
+        self.segments = []
+        size = capacity if capacity is not None else self.chunk
+        self.step = np.zeros(size, dtype=np.int64)
+        self.initiator = np.zeros(size, dtype=np.int64)
+        self.partner = np.zeros(size, dtype=np.int64)
+        # goods[:, 0] is what the initiator gave, goods[:, 1] what they took
+        self.goods = np.zeros((size, 2, K))
+        # prev[:, 0] is the initiator's previous trade, prev[:, 1] the
+        # partner's; -1 for none
+        self.prev = np.full((size, 2), -1, dtype=np.int64)
+        self.last = np.zeros(0, dtype=np.int64)
+        self.recent = np.full((0, recent), -1, dtype=np.int64)
+        self.recent_count = np.zeros(0, dtype=np.int64)
+        self.pair_trade = np.full((K, K), -1, dtype=np.int64)
+        self.pair_price = np.full((K, K), np.nan)
+        if spill is not None:
+            os.makedirs(spill, exist_ok=True)
+
+    def __len__(self):
+        """Number of trades still held in memory"""
+        return self.count - self.first
+
+    @property
+    def first(self):
+        """Index of the oldest trade still held in memory"""
+        if self.capacity is None:
+            return self.base
+        return max(0, self.count - self.capacity)
+
+    def append(self, step, initiator, partner, given, taken):
+        """Record a single trade. Same as extend with one row, written
+        straight into the columns without building any arrays."""
+        if self.capacity is None and \
+                self.count - self.base == len(self.step):
+            self._grow(self.count - self.base + 1)
+        row = self._slot(self.count)
+        self._note_agent(initiator, self.count, row, 0)
+        if partner != initiator:
+            self._note_agent(partner, self.count, row, 1)
+        self._note_pairs(self.count, given, taken)
+        self.step[row] = step
+        self.initiator[row] = initiator
+        self.partner[row] = partner
+        self.goods[row, 0] = given
+        self.goods[row, 1] = taken
+        self.count += 1
+        if self.spill is not None and self.count - self.spilled >= self.chunk:
+            self._spill()
+
+    def extend(self, step, initiators, partners, given, taken):
+        """Record a batch of trades made during `step`"""
+        initiators = np.asarray(initiators)
+        n = len(initiators)
+        done = 0
+        while done < n:
+            # never write past a chunk boundary, so a full chunk is spilled
+            # before the ring can overwrite any of it
+            room = self.chunk - (self.count - self.spilled) % self.chunk
+            if self.spill is None:
+                room = n - done
+            take = min(room, n - done)
+            self._write(step, initiators[done:done + take],
+                        np.asarray(partners)[done:done + take],
+                        np.asarray(given)[done:done + take],
+                        np.asarray(taken)[done:done + take])
+            done += take
+            if self.spill is not None and \
+                    self.count - self.spilled >= self.chunk:
+                self._spill()
+
+    def _write(self, step, initiators, partners, given, taken):
+        n = len(initiators)
+        if self.capacity is None and \
+                self.count - self.base + n > len(self.step):
+            self._grow(self.count - self.base + n)
+        rows = self._slot(np.arange(self.count, self.count + n))
+        self.step[rows] = step
+        self.initiator[rows] = initiators
+        self.partner[rows] = partners
+        self.goods[rows, 0] = given
+        self.goods[rows, 1] = taken
+        self._index(initiators, partners, given, taken)
+        self.count += n
+
+    def _index(self, initiators, partners, given, taken):
+        """Add a batch of trades, numbered from self.count on, to the
+        indexes"""
+        n = len(initiators)
+        if n == 0:
+            return
+        numbers = np.arange(self.count, self.count + n)
+        initiators = np.asarray(initiators)
+        partners = np.asarray(partners)
+        other = partners != initiators  # a trade with oneself counts once
+        ids = np.concatenate([initiators, partners[other]]).astype(np.int64)
+        numbers = np.concatenate([numbers, numbers[other]])
+        sides = np.repeat([0, 1], [n, len(ids) - n])
+        if ids.max() >= len(self.recent_count):
+            self._grow_agents(ids.max() + 1)
+        order = np.lexsort((numbers, ids))
+        ids, numbers, sides = ids[order], numbers[order], sides[order]
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+        counts = np.diff(np.r_[starts, len(ids)])
+        # chain each agent's trades in this batch, oldest first, on to its
+        # last one before it
+        prev = np.r_[-1, numbers[:-1]]
+        prev[starts] = self.last[ids[starts]]
+        self.prev[self._slot(numbers), sides] = prev
+        self.last[ids[starts + counts - 1]] = numbers[starts + counts - 1]
+        # and put them in the next slots of its ring; only its last
+        # `recent` of them matter
+        rank = np.arange(len(ids)) - np.repeat(starts, counts)
+        keep = rank >= np.repeat(counts, counts) - self.recent.shape[1]
+        slot = (self.recent_count[ids] + rank) % self.recent.shape[1]
+        self.recent[ids[keep], slot[keep]] = numbers[keep]
+        self.recent_count[ids[starts]] += counts
+        # pairs of goods: a trade in which every good changes hands both
+        # ways sets every pair, so start from the last such trade
+        given = np.asarray(given).reshape(n, self.K)
+        taken = np.asarray(taken).reshape(n, self.K)
+        full = np.flatnonzero((given > 0).all(axis=1) &
+                              (taken > 0).all(axis=1))
+        first = full[-1] if len(full) else 0
+        for row in range(first, n):
+            self._note_pairs(self.count + row, given[row], taken[row])
+
+    def _note_agent(self, agent, number, row, side):
+        if agent >= len(self.recent_count):
+            self._grow_agents(agent + 1)
+        self.prev[row, side] = self.last[agent]
+        self.last[agent] = number
+        slot = self.recent_count[agent] % self.recent.shape[1]
+        self.recent[agent, slot] = number
+        self.recent_count[agent] += 1
+
+    def _note_pairs(self, number, given, taken):
+        gave = np.flatnonzero(given > 0)
+        took = np.flatnonzero(taken > 0)
+        if len(gave) == 0 or len(took) == 0:
+            return
+        pairs = np.ix_(gave, took)
+        self.pair_trade[pairs] = number
+        self.pair_price[pairs] = taken[took] / given[gave, None]
+
+    def _grow_agents(self, needed):
+        size = max(needed, 2 * len(self.recent_count))
+        recent = np.full((size, self.recent.shape[1]), -1, dtype=np.int64)
+        recent[:len(self.recent)] = self.recent
+        self.recent = recent
+        counts = np.zeros(size, dtype=np.int64)
+        counts[:len(self.recent_count)] = self.recent_count
+        self.recent_count = counts
+        last = np.full(size, -1, dtype=np.int64)
+        last[:len(self.last)] = self.last
+        self.last = last
+
+    def restore(self, cols, count, pair_trade=None, pair_price=None):
+        """Refill an empty ledger with `cols`, the last trades of a ledger
+        that had recorded `count` trades (a tail of it, see
+        mkt.get_state), and the pairs of goods index it had. Nothing
+        before the tail is held or spilled: this ledger spills, if at all,
+        from trade `count` on."""
+        self.count = self.base = count - len(cols["step"])
+        self._write(cols["step"], cols["initiator"], cols["partner"],
+                    cols["goods"][:, 0], cols["goods"][:, 1])
+        self.spilled = self.count
+        if pair_trade is not None:
+            self.pair_trade[:] = pair_trade
+            self.pair_price[:] = pair_price
+
+    def _grow(self, needed):
+        size = max(needed, 2 * len(self.step))
+        for name in ("step", "initiator", "partner", "goods", "prev"):
+            old = getattr(self, name)
+            new = np.zeros((size,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _spill(self):
+        cols = self._rows(self.spilled, self.spilled + self.chunk)
+        path = os.path.join(self.spill,
+                            "trades_%06d.npz" % len(self.segments))
+        np.savez(path, **cols)
+        self.segments.append(path)
+        self.spilled += self.chunk
+
+    def _rows(self, start, stop):
+        """Columns for trades start..stop, which must still be in memory"""
+        rows = self._slot(np.arange(start, stop))
+        return {"step": self.step[rows],
+                "initiator": self.initiator[rows],
+                "partner": self.partner[rows],
+                "goods": self.goods[rows]}
+
+    def tail(self, n=None):
+        """The last n trades held in memory (all of them by default),
+        oldest first, as a dict of columns."""
+        start = self.first if n is None else max(self.first, self.count - n)
+        return self._rows(start, self.count)
+
+    def read(self):
+        """Every trade recorded, including spilled segments"""
+        if not self.segments:
+            return self.tail()
+        parts = [dict(np.load(path)) for path in self.segments]
+        parts.append(self._rows(self.spilled, self.count))
+        return {name: np.concatenate([p[name] for p in parts])
+                for name in parts[0]}
+
+    def _slot(self, number):
+        """Row of the columns holding trade `number` (or an array of
+        them)"""
+        if self.capacity is None:
+            return number - self.base
+        return number % self.capacity
+
+    def trades_of(self, agent):
+        """Numbers of all agent's trades still held in memory, oldest
+        first"""
+        numbers = []
+        first = self.first
+        number = self.last[agent] if agent < len(self.last) else -1
+        # numbers only go down along the chain, so the first one that's
+        # gone from memory ends it
+        while number >= first:
+            numbers.append(number)
+            row = self._slot(number)
+            number = self.prev[row, 0 if self.initiator[row] == agent else 1]
+        return np.array(numbers[::-1], dtype=np.int64)
+
+    def recent_of(self, agent):
+        """Numbers of agent's last `recent` trades that are still held in
+        memory, oldest first"""
+        if agent >= len(self.recent_count):
+            return np.zeros(0, dtype=np.int64)
+        numbers = self.recent[agent]
+        return np.sort(numbers[numbers >= self.first])
+
+    def sample(self, involving=None, rng=np.random):
+        """The goods of a random trade held in memory, or with `involving`
+        one of that agent's trades held in memory. None if there isn't
+        one."""
+        if involving is None:
+            if len(self) == 0:
+                return None
+            # choice, unlike integers, is on np.random and Generators alike
+            number = self.first + rng.choice(len(self))
+        else:
+            numbers = self.trades_of(involving)
+            if len(numbers) == 0:
+                return None
+            number = rng.choice(numbers)
+        return self.goods[self._slot(number)].copy()
+
+    def last_price(self, i, j):
+        """Units of good j per unit of good i in the last trade that
+        swapped one for the other, either way round; nan if none has"""
+        if self.pair_trade[i, j] >= self.pair_trade[j, i]:
+            return self.pair_price[i, j]
+        return 1 / self.pair_price[j, i]
@@ -0,0 +1,216 @@
+"""
+A live view of a large run.
+
+The model steps as fast as it can on a background thread, so a slow
+browser never holds it up. A fixed number of times a second the server
+sends each browser only what changed since the last frame: the agents
+that moved and the new chart points. Charts keep a bounded number of
+points by halving their resolution whenever they fill up.
+
+    python run.py --live --N 100000 --vectorized
+"""
+import json
+import threading
+import numpy as np
+import tornado.ioloop
+import tornado.web
+import tornado.websocket
+from model import mkt
+from sweep import bounded
+
+
+class Series():
+    """Chart points [step, Mean_Utility, Mean_Specialization], at most
+    max_points of them. When full, every other point is dropped and only
+    every stride-th step is kept from then on."""
+    def __init__(self, max_points=500):
+        self.max_points = max_points
+        self.stride = 1
+        self.points = []
+        self.version = 0  # bumped whenever old points are dropped
+
+    def add(self, step, *values):
+        if step % self.stride:
+            return
+        self.points.append([step, *values])
+        if len(self.points) > self.max_points:
+            self.points = self.points[1::2]
+            self.stride *= 2
+            self.version += 1
+
+
+class Runner(threading.Thread):
+    """Steps the model in the background until stopped, publishing a
+    snapshot after every step"""
+    def __init__(self, model, max_points=500):
+        super().__init__(daemon=True)
+        self.model = model
+        self.series = Series(max_points)
+        self.stopped = threading.Event()
+        self.publish()
+
+    def run(self):
+        model = self.model
+        while model.running and not self.stopped.is_set():
+            model.advance()
+            self.series.add(model.schedule.steps,
+                            float(model.mean_utility),
+                            float(model.mean_specialization))
+            self.publish()
+
+    def publish(self):
+        # a new tuple of copies each time, swapped in whole, so readers
+        # never wait for a step or see one half done
+        self.latest = (self.model.schedule.steps,
+                       self.model.positions().copy(),
+                       self.series.version, list(self.series.points))
+
+    def snapshot(self):
+        """step, positions, chart version and points after the last
+        finished step"""
+        return self.latest
+
+
+class Frames():
+    """Works out what changed between frames and sends it to browsers.
+    Every browser is in step with the last frame sent: a new one is
+    given the state as of that frame, so the next frame's changes apply
+    to it as to the rest."""
+    def __init__(self, runner):
+        self.runner = runner
+        self.clients = set()
+        self.step = 0
+        self.pos = None
+        self.version = -1
+        self.points = []  # chart points as of the last frame
+
+    def rebase(self):
+        """Take the model's current state as the last frame's"""
+        self.step, self.pos, self.version, self.points = \
+            self.runner.snapshot()
+
+    def full(self):
+        if self.pos is None:
+            self.rebase()
+        grid = self.runner.model._grid
+        return {"full": True, "step": self.step,
+                "width": grid.width, "height": grid.height,
+                "xy": self.pos.ravel().tolist(), "points": self.points}
+
+    def frame(self):
+        if not self.clients:
+            return
+        sent = len(self.points)
+        before = self.pos, self.version
+        self.rebase()
+        pos, points = self.pos, self.points
+        moved = np.flatnonzero((pos != before[0]).any(axis=1))
+        if self.version != before[1]:
+            sent = 0
+        message = {"step": self.step, "moved": moved.tolist(),
+                   "xy": pos[moved].ravel().tolist(),
+                   "reset": sent == 0, "points": points[sent:]}
+        message = json.dumps(message)
+        for client in list(self.clients):
+            client.write_message(message)
+
+
+class Socket(tornado.websocket.WebSocketHandler):
+    def initialize(self, frames):
+        self.frames = frames
+
+    def open(self):
+        self.write_message(json.dumps(self.frames.full()))
+        self.frames.clients.add(self)
+
+    def on_close(self):
+        self.frames.clients.discard(self)
+
+
+class Page(tornado.web.RequestHandler):
+    def get(self):
+        self.write(PAGE)
+
+
+def serve(port=8522, fps=10, max_points=500, **params):
+    """Run mkt(**params) in the background and serve the live view"""
+    params.setdefault("N", 1000)
+    params.setdefault("K", 2)
+    # the run never ends, so its ledger can't keep every trade
+    runner = Runner(mkt(**bounded(params)), max_points)
+    frames = Frames(runner)
+    app = tornado.web.Application([
+        (r"/", Page),
+        (r"/ws", Socket, {"frames": frames})])
+    app.listen(port)
+    tornado.ioloop.PeriodicCallback(frames.frame, 1000 / fps).start()
+    runner.start()
+    print("Serving on http://127.0.0.1:%d" % port)
+    try:
+        tornado.ioloop.IOLoop.current().start()
+    finally:
+        runner.stopped.set()
+
+
+PAGE = """<!DOCTYPE html>
+<html><head><title>Comparative Advantage (live)</title></head>
+<body>
+<div id="step">step 0</div>
+<canvas id="grid" width="500" height="500"></canvas>
+<canvas id="utility" width="500" height="150"></canvas>
+<canvas id="specialization" width="500" height="150"></canvas>
+<script>
+var W = 1, H = 1, xy = [], counts = [], points = [];
+function cell(x, y) { return x * H + y; }
+function drawGrid() {
+  var c = document.getElementById("grid").getContext("2d");
+  var cw = 500 / W, ch = 500 / H, most = Math.max.apply(null, counts) || 1;
+  c.clearRect(0, 0, 500, 500);
+  for (var x = 0; x < W; x++) for (var y = 0; y < H; y++) {
+    var n = counts[cell(x, y)];
+    if (!n) continue;
+    c.fillStyle = "rgba(255,0,0," + (0.2 + 0.8 * n / most) + ")";
+    c.fillRect(x * cw, 500 - (y + 1) * ch, cw, ch);
+  }
+}
+function drawChart(id, col, color) {
+  var c = document.getElementById(id).getContext("2d");
+  c.clearRect(0, 0, 500, 150);
+  if (points.length < 2) return;
+  var lo = Infinity, hi = -Infinity;
+  points.forEach(function (p) { lo = Math.min(lo, p[col]);
+                                hi = Math.max(hi, p[col]); });
+  var s0 = points[0][0], s1 = points[points.length - 1][0];
+  c.strokeStyle = color; c.beginPath();
+  points.forEach(function (p, i) {
+    var px = 500 * (p[0] - s0) / (s1 - s0 || 1);
+    var py = 145 - 140 * (p[col] - lo) / (hi - lo || 1);
+    if (i) c.lineTo(px, py); else c.moveTo(px, py);
+  });
+  c.stroke();
+  c.fillStyle = color;
+  c.fillText(id + ": " + points[points.length - 1][col].toFixed(3), 5, 12);
+}
+var ws = new WebSocket("ws://" + location.host + "/ws");
+ws.onmessage = function (event) {
+  var m = JSON.parse(event.data);
+  if (m.full) {
+    W = m.width; H = m.height; xy = m.xy; points = m.points;
+    counts = new Array(W * H).fill(0);
+    for (var i = 0; i < xy.length; i += 2) counts[cell(xy[i], xy[i + 1])]++;
+  } else {
+    m.moved.forEach(function (id, i) {
+      counts[cell(xy[2 * id], xy[2 * id + 1])]--;
+      xy[2 * id] = m.xy[2 * i]; xy[2 * id + 1] = m.xy[2 * i + 1];
+      counts[cell(xy[2 * id], xy[2 * id + 1])]++;
+    });
+    points = m.reset ? m.points : points.concat(m.points);
+  }
+  document.getElementById("step").textContent = "step " + m.step;
+  drawGrid();
+  drawChart("utility", 1, "black");
+  drawChart("specialization", 2, "green");
+};
+</script>
+</body></html>
+"""
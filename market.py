@@ -0,0 +1,157 @@
+"""
+Order books for money mode (mkt.money = True).
+
+Instead of bartering with a random partner, every agent posts a bid and
+an ask in good 0 for each of the other goods (see kernels.quotes): asks
+from what the good costs it to make (ant.prices), bids from what the
+good is worth to it. With mkt.money_learn set, every fill also moves both
+sides' prod_plan the way exchange.undertake(update=True) means to, so
+agents shift production towards what they sell. Each
+good has its own book: a max-heap of bids and a min-heap of asks. An
+incoming order trades against the best resting orders on the other side
+for as long as the prices cross, at the resting order's price, and any
+remainder rests in the book. Each match is a heap pop and maybe a push,
+so O(log n) in the orders resting. Books are emptied at the end of each
+step, since quotes are only good for the day they were made.
+"""
+import heapq
+import numpy as np
+import kernels
+
+# Orders smaller than this are dropped rather than kept in the book
+DUST = 1e-12
+
+
+def learn(prod_plan, step):
+    """Move prod_plan by step in place, keeping it a valid plan:
+    nonnegative shares that sum to 1"""
+    prod_plan += step
+    np.maximum(prod_plan, 0, out=prod_plan)
+    prod_plan /= prod_plan.sum()
+
+
+class OrderBook():
+    """Resting orders for one good. Entries are (price, seq, agent, size),
+    with bid prices negated so both heaps pop the best price first and,
+    among equal prices, the oldest order."""
+    def __init__(self, market, good):
+        self.market = market
+        self.good = good
+        self.bids = []
+        self.asks = []
+        self.seq = 0
+
+    def bid(self, agent, price, size):
+        """agent wants to buy up to size units at up to price"""
+        market, good, asks = self.market, self.good, self.asks
+        while size > DUST and asks and asks[0][0] <= price:
+            ask_price, seq, seller, offered = heapq.heappop(asks)
+            offered = min(offered, market.can_sell(seller, good))
+            size = min(size, market.can_buy(agent, ask_price))
+            traded = min(size, offered)
+            if traded > DUST:
+                market.settle(good, agent, seller, ask_price, traded)
+                size -= traded
+                offered -= traded
+            if offered > DUST:
+                heapq.heappush(asks, (ask_price, seq, seller, offered))
+                if traded <= DUST:
+                    break  # the buyer can't afford any more
+        if size > DUST:
+            self.seq += 1
+            heapq.heappush(self.bids, (-price, self.seq, agent, size))
+
+    def ask(self, agent, price, size):
+        """agent wants to sell up to size units at no less than price"""
+        market, good, bids = self.market, self.good, self.bids
+        while size > DUST and bids and -bids[0][0] >= price:
+            bid_price, seq, buyer, wanted = heapq.heappop(bids)
+            wanted = min(wanted, market.can_buy(buyer, -bid_price))
+            size = min(size, market.can_sell(agent, good))
+            traded = min(size, wanted)
+            if traded > DUST:
+                market.settle(good, buyer, agent, -bid_price, traded)
+                size -= traded
+                wanted -= traded
+            if wanted > DUST:
+                heapq.heappush(bids, (bid_price, seq, buyer, wanted))
+                if traded <= DUST:
+                    break  # the seller has nothing left to sell
+        if size > DUST:
+            self.seq += 1
+            heapq.heappush(self.asks, (price, self.seq, agent, size))
+
+    def clear(self):
+        self.bids.clear()
+        self.asks.clear()
+
+
+class Market():
+    """A book for each of goods 1..K-1, all priced in good 0. Nobody
+    parts with more than half of what they hold at the moment of a trade,
+    the same budget kernels.trade uses."""
+    def __init__(self, model, margin=0.05):
+        self.model = model
+        self.margin = margin
+        self.books = [OrderBook(self, good) for good in range(model.K)]
+        self.prices = np.full(model.K, np.nan)  # last price of each good
+        self.prices[0] = 1.
+        self.volume = np.zeros(model.K)  # units traded this step
+
+    def post(self, ids, endowment, prod_plan, ppf, u_params):
+        """Post the quotes of agents `ids` (a list, matching the rows of
+        the arrays), one agent at a time in the order given"""
+        bid, ask, bid_size, ask_size = kernels.quotes(
+            endowment, prod_plan, ppf, u_params, self.margin)
+        books = self.books
+        for row, agent in enumerate(ids):
+            for good in range(1, len(books)):
+                j = good - 1
+                if bid_size[row, j] > DUST:
+                    books[good].bid(agent, bid[row, j], bid_size[row, j])
+                if ask_size[row, j] > DUST:
+                    books[good].ask(agent, ask[row, j], ask_size[row, j])
+
+    def endowment(self, agent):
+        return self.model.ants[agent].endowment
+
+    def can_sell(self, agent, good):
+        return max(self.endowment(agent)[good] / 2, 0.)
+
+    def can_buy(self, agent, price):
+        return max(self.endowment(agent)[0] / 2 / price, 0.)
+
+    def settle(self, good, buyer, seller, price, size):
+        """buyer pays size * price of good 0 for size units of good"""
+        model = self.model
+        b, s = model.ants[buyer], model.ants[seller]
+        paid = size * price
+        b.endowment[0] -= paid
+        b.endowment[good] += size
+        s.endowment[0] += paid
+        s.endowment[good] -= size
+        given = np.zeros(model.K)
+        taken = np.zeros(model.K)
+        given[0] = paid
+        taken[good] = size
+        if model.money_learn:
+            # as undertake(update=True), with the buyer as partners[0]:
+            # each side makes more of what it handed over
+            delta = given - taken
+            learn(b.prod_plan, delta * b.learning_rate)
+            learn(s.prod_plan, -delta * s.learning_rate)
+        b.touch()
+        s.touch()
+        self.prices[good] = price
+        self.volume[good] += size
+        model.ledger.append(model.schedule.steps, buyer, seller, given,
+                            taken)
+
+    def open(self):
+        """Start of the day"""
+        self.volume[:] = 0
+
+    def close(self):
+        """End of the day: drop every resting order"""
+        for book in self.books:
+            book.clear()
@@ -1,8 +1,17 @@
+import copy
+import itertools
 import numpy as np
+import kernels
+import checkpoint
+import profiling
+from aggregates import Tally
+from collector import ArrayCollector
+from ledger import TradeLedger
+from market import Market
+from streams import Streams
 from mesa import Model, Agent
 from mesa.time import RandomActivation
 from mesa.space import MultiGrid
-from mesa.datacollection import DataCollector
 
 
 def utility_reporter(agent):
@@ -12,45 +21,80 @@ def utility_reporter(agent):
 
 def specialization_reporter(agent):
     """How much of agent's time is spent on their most popular good?"""
-    return agent.prod_plan.max() / agent.prod_plan.sum()
+    return agent.specialization
+
+
+# Per-agent state that a checkpoint has to carry
+AGENT_ARRAYS = ("ppf", "endowment", "prod_plan", "u_params", "learning_rate")
+# Most trades of the ledger that a checkpoint or fork carries over
+LEDGER_TAIL = 100000
+# Model switches that can be changed after construction
+FLAGS = ("consume", "units", "trade", "solo_update", "money", "money_learn",
+         "self_trade", "local", "running")
+# mkt()'s arguments, for building one from a grid or a config file
+MODEL_ARGS = ("N", "K", "width", "height", "trade", "vectorized",
+              "ledger_size", "ledger_spill", "seed", "spread", "collector",
+              "local", "profile", "compact", "dtype", "top_k")
+
+
+# ant's array attributes, in the order they sit in a compact model's buffer
+ANT_ROWS = ("ppf", "endowment", "prod_plan", "prices", "u_params")
 
 
 class ant(Agent):
     """An agent with heterogeneous preferences and capabilities"""
-    def __init__(self, unique_id, model, K, N):
+    __slots__ = ANT_ROWS + ("rng", "trades_done", "memory", "age",
+                            "learning_rate", "specialization", "_utility")
+
+    def __init__(self, unique_id, model):
         super().__init__(unique_id, model)
         K = self.model.K
+        self.rng = model.streams.agent(unique_id)
         # self.endowment = 10 * np.random.rand(K)
         # self.endowment = np.random.randint(10, 20, K, dtype='float64')
         # self.endowment = self.endowment * 1.0
         # self.endowment.dtype = 'float64'
-        self.ppf = np.random.randint(1, 4, K)
-        self.endowment = 10. * self.ppf
-        prod_plan = np.ones(K)
-        self.prod_plan = prod_plan / prod_plan.sum()
-        self.prices = self.ppf[0] / self.ppf
-        u_params = np.random.randint(1, 4, K)
-        self.u_params = u_params / u_params.sum()
+        if model.compact:
+            # views of this agent's rows of one model-wide buffer
+            rows = model.agent_buffer[unique_id]
+        else:
+            rows = [np.empty(K, model.dtype) for _ in ANT_ROWS]
+        (self.ppf, self.endowment, self.prod_plan, self.prices,
+         self.u_params) = rows
+        self.ppf[:] = self.rng.integers(1, 4, K)
+        self.endowment[:] = 10. * self.ppf
+        self.prod_plan[:] = 1. / K
+        self.prices[:] = self.ppf[0] / self.ppf
+        u_params = self.rng.integers(1, 4, K)
+        self.u_params[:] = u_params / u_params.sum()
         self.trades_done = 0
         self.memory = 10
         self.age = 0
         self.learning_rate = 0.05
-        self.specialization = specialization_reporter(self)
-        # self.utility = 0
+        self.specialization = kernels.specialization(self.prod_plan)
+        self._utility = None
 
     def step(self):
+        profile = self.model.profile
         self.age += 1
-        self.move()
-        self.produce()
-        if self.model.trade:
-            partner = self.find_partner()
+        with profile.phase("move"):
+            self.move()
+        with profile.phase("produce"):
+            self.produce()
+        if self.model.trade and self.model.money:
+            with profile.phase("market"):
+                self.post_orders()
+        elif self.model.trade:
+            with profile.phase("find_partner"):
+                partner = self.find_partner()
             self.trade(partner)
         if self.model.consume:
-            self.consume()
+            with profile.phase("consume"):
+                self.consume()
         if self.model.solo_update:
-            self.solo_update()
-        # self.utility = self.utility()
-        self.specialization = specialization_reporter(self)
+            with profile.phase("solo_update"):
+                self.solo_update()
+        self.specialization = kernels.specialization(self.prod_plan)
 
     def move(self):
         possible_steps = self.model.grid.get_neighborhood(
@@ -63,109 +107,589 @@ class ant(Agent):
     def produce(self):
         prod = self.prod_plan * self.ppf
         self.endowment += prod
+        self.touch()
         return self
 
+    def touch(self):
+        """Note that endowment or prod_plan changed, so the cached utility
+        and the model's tallies need refreshing."""
+        self._utility = None
+        self.model.dirty.add(self.unique_id)
+
     def solo_update(self):
         """Update production plans in the
         direction of what will maximize utility."""
         delta1 = self.u_params * 1/self.u_params.min()
         self.prod_plan += delta1 * self.learning_rate
-        self.prod_plan = self.prod_plan / self.prod_plan.sum()
+        self.prod_plan /= self.prod_plan.sum()
+        self.touch()
 
     def find_partner(self):
-        p = np.random.randint(self.model.schedule.get_agent_count())
-        if p > 1:
-            partner = self.model.schedule.agents[p]
-            if partner == self:
-                partner = self.find_partner()
-            return partner
-        else:
+        """Pick any other agent, uniformly at random, or with
+        model.local set, one on the same ("cell") or a neighbouring
+        ("neighbors") cell. Alone there, or in the model, the agent trades
+        with itself, which changes nothing."""
+        if self.model.local:
+            if self.model.local == "cell":
+                near = self.model.grid.get_cell_list_contents([self.pos])
+            elif self.model.local == "neighbors":
+                near = self.model.grid.get_neighbors(
+                    self.pos, moore=True, include_center=True)
+            else:
+                raise ValueError(
+                    "local trading is by \"cell\" or \"neighbors\" in the "
+                    "per-agent engine, not %r" % (self.model.local,))
+            # sorted so the pick doesn't depend on the order agents
+            # arrived in their cells
+            near = sorted((a for a in near if a is not self),
+                          key=lambda a: a.unique_id)
+            if not near:
+                self.model.profile.count("partner_misses")
+                return self
+            return near[self.rng.integers(len(near))]
+        if self.model.self_trade:
+            return self.model.ants[self.rng.integers(self.model.N)]
+        if self.model.N < 2:
+            self.model.profile.count("partner_misses")
             return self
+        p = self.rng.integers(self.model.N - 1)
+        if p >= self.unique_id:
+            p += 1
+        return self.model.ants[p]
 
-    def consume(self, units=5):
+    def consume(self, units=None):
         """Use up goods based on weighted probability"""
-        # Don't risk going negative
-        if self.endowment.max() < 1:
-            return self
-        if units < 1:
-            return self
-        probs = self.u_params
-        eat = np.random.choice(range(self.model.K),
-                               size=1, p=probs)
-        self.endowment[eat] -= 1
-        self.consume(units - 1)
+        if units is None:
+            units = self.model.units
+        kernels.consume(self.endowment[None], self.u_params[None], units,
+                        self.rng)
+        self.touch()
         return self
 
     def utility(self):
-        return (self.endowment ** self.u_params).sum()
+        if self._utility is None:
+            self._utility = (self.endowment ** self.u_params).sum()
+        return self._utility
 
     def trade(self, partner):
         """Create an exchange, """
         # Start with one days production, scale down to match endowments
+        profile = self.model.profile
         deal = exchange([self, partner], self.model)
-        deal = deal.day_trade()
-        deal.undertake()
+        with profile.phase("day_trade"):
+            deal = deal.day_trade()
+        with profile.phase("undertake"):
+            deal.undertake()
+        return self
+
+    def post_orders(self):
+        """Money mode: quote for every good in the model's order books"""
+        self.model.market.post([self.unique_id], self.endowment[None],
+                               self.prod_plan[None], self.ppf[None],
+                               self.u_params[None])
         return self
 
     def has(self, goods):
         have = self.endowment > goods
         return all(have)
 
+
+def _row(name):
+    """Property reading and writing this agent's row of a model array.
+    With sparse goods the row is spread out over all K goods on reading
+    (a copy), and only the agent's own goods are written back."""
+    def fget(self):
+        row = getattr(self.model, name)[self.unique_id]
+        goods = self.model.goods
+        if goods is None or row.ndim == 0:
+            return row
+        dense = np.zeros(self.model.K, row.dtype)
+        dense[goods[self.unique_id]] = row
+        return dense
+
+    def fset(self, value):
+        goods = self.model.goods
+        if goods is not None and np.ndim(value):
+            value = np.asarray(value)[goods[self.unique_id]]
+        getattr(self.model, name)[self.unique_id] = value
+    return property(fget, fset)
+
+
+class ant_view(ant):
+    """A thin handle on one row of the model's agent arrays.
+    Used by the vectorized engine so Mesa's schedule, grid and data
+    collector still see individual agents."""
+    __slots__ = ("_rng",)
+    ppf = _row("ppf")
+    endowment = _row("endowment")
+    prod_plan = _row("prod_plan")
+    u_params = _row("u_params")
+    learning_rate = _row("learning_rate")
+
+    def __init__(self, unique_id, model):
+        Agent.__init__(self, unique_id, model)
+        self.trades_done = 0
+        self.memory = 10
+        self._rng = None
+
+    @property
+    def rng(self):
+        if self._rng is None:
+            self._rng = self.model.streams.agent(self.unique_id)
+        return self._rng
+
+    @property
+    def age(self):
+        return self.model.schedule.steps
+
+    @property
+    def pos(self):
+        x, y = self.model.pos[self.unique_id]
+        return (int(x), int(y))
+
+    @pos.setter
+    def pos(self, value):
+        # Agent.__init__ and grid.remove_agent set pos to None
+        if value is not None:
+            self.model.pos[self.unique_id] = value
+
+    @property
+    def prices(self):
+        return self.ppf[0] / self.ppf
+
+    @property
     def specialization(self):
-        self.prod_plan.max() / self.prod_plan.sum()
+        return self.model.spec_stats.values[self.unique_id]
+
+    def utility(self):
+        return self.model.utility_stats.values[self.unique_id]
 
 
 class mkt(Model):
-    def __init__(self, N, K, width=10, height=10, trade=True):
+    def __init__(self, N, K, width=10, height=10, trade=True,
+                 vectorized=False, ledger_size=None, ledger_spill=None,
+                 seed=None, spread=False, collector="mesa", local=None,
+                 profile=False, compact=False, dtype=np.float64,
+                 top_k=None):
         super().__init__()
+        self.streams = Streams(seed)
+        self.random = self.streams.python()
         self.N = N
         self.K = K
         self.consume = False
+        self.units = 5
         self.trade = trade
         self.solo_update = True
         self.money = False
+        # money mode fills move prod_plan, see market
+        self.money_learn = False
+        self.self_trade = False
+        # local trading: "cell" in either engine, else "neighbors" (the
+        # Moore neighbourhood) per agent or "block" (kernels.trade_groups)
+        # vectorized
+        if local not in (None, False, "cell",
+                         "block" if vectorized else "neighbors"):
+            raise ValueError("local=%r doesn't work with vectorized=%r"
+                             % (local, vectorized))
+        self.local = local
+        self.vectorized = vectorized
+        self.compact = compact
+        self.dtype = np.dtype(dtype)
+        if top_k is not None and not vectorized:
+            raise ValueError("top_k needs the vectorized engine")
+        # with top_k, each agent only deals in its own k goods, listed in
+        # the rows of goods; see the sparse kernels
+        self.top_k = top_k
+        self.goods = None
+        self.spread = spread
         self.running = True
-        self.history = []
-        self.grid = MultiGrid(width, height, True)
+        # a convergence.Convergence here ends the run once it settles
+        self.convergence = None
+        self.converged_step = None
+        # a parallel.Workers here steps the vectorized engine in processes
+        self.workers = None
+        self.profile = profiling.Profile(vectorized) if profile else \
+            profiling.OFF
+        self.ledger = TradeLedger(K, capacity=ledger_size,
+                                  spill=ledger_spill)
+        self.market = Market(self)
+        self._grid = MultiGrid(width, height, True)
+        self._grid_stale = False
         self.schedule = RandomActivation(self)
+        self.ants = []
+        self._occupied = np.arange(0)
+        self.utility_stats = Tally(np.zeros(N), spread)
+        self.spec_stats = Tally(np.zeros(N), spread)
+        self.dirty = set(range(N))
+        if vectorized:
+            self.init_arrays()
+        elif compact:
+            self.agent_buffer = np.empty((N, len(ANT_ROWS), K), self.dtype)
         # create agents
         for a in range(self.N):
-            a = ant(a, self)
+            a = ant_view(a, self) if vectorized else ant(a, self)
+            self.ants.append(a)
             self.schedule.add(a)
-            x = self.random.randrange(self.grid.width)
-            y = self.random.randrange(self.grid.height)
-            self.grid.place_agent(a, (x, y))
-        all_utility = [agent.utility() for agent in self.schedule.agents]
-        self.mean_utility = sum(all_utility) / self.N
-        all_spec = [agent.specialization() for agent in self.schedule.agents]
-        self.mean_specialization = sum(all_spec) / self.N
-        self.datacollector = DataCollector(
-            model_reporters={"Mean_Utility": "mean_utility",
-                             "Mean_Specialization": "mean_specialization"},
-            agent_reporters={"Utility": utility_reporter,
-                             "Specialization": specialization_reporter})
+        self._ant_array = np.empty(N, dtype=object)
+        self._ant_array[:] = self.ants
+        place = self.streams.rows("place")
+        self.place_all(place.integers(0, [width, height], (N, 2)))
+        self.update_means()
+        model_reporters = {"Mean_Utility": "mean_utility",
+                           "Mean_Specialization": "mean_specialization"}
+        if spread:
+            for stat in ("Var", "Min", "Max"):
+                for name in ("Utility", "Specialization"):
+                    label = stat + "_" + name
+                    model_reporters[label] = label.lower()
+        if profile:
+            model_reporters.update(profiling.reporters(vectorized))
+        if collector == "array":
+            self.datacollector = ArrayCollector(self, model_reporters)
+        else:
+            # imports pandas, so only when asked for
+            from mesa.datacollection import DataCollector
+            self.datacollector = DataCollector(
+                model_reporters=model_reporters,
+                agent_reporters={"Utility": utility_reporter,
+                                 "Specialization": specialization_reporter})
+
+    @property
+    def grid(self):
+        """The Mesa grid. The vectorized engine moves agents in the pos
+        array and only brings the grid up to date when someone looks."""
+        if self._grid_stale:
+            self._grid_stale = False
+            self.place_all(self.pos)
+        return self._grid
+
+    def place_all(self, pos):
+        """Put every agent on the grid at once, at rows of `pos`.
+        MultiGrid.place_agent scans the cell for the agent first, which is
+        quadratic once thousands of agents share a cell. Only the cells
+        that were or are now occupied are visited, so this stays linear in
+        N however large the grid."""
+        grid = self._grid
+        cells = pos[:, 0] * grid.height + pos[:, 1]
+        order, start = kernels.cell_index(cells, grid.width * grid.height)
+        occupied = np.flatnonzero(np.diff(start))
+        if self.vectorized:
+            # grid cells only change here, so the last call's are current
+            before = self._occupied
+        else:
+            before = np.arange(grid.width * grid.height)
+        for c in before.tolist():
+            grid.grid[c // grid.height][c % grid.height] = []
+        for c in occupied.tolist():
+            grid.grid[c // grid.height][c % grid.height] = \
+                self._ant_array[order[start[c]:start[c + 1]]].tolist()
+        freed = np.setdiff1d(before, occupied)
+        taken = np.setdiff1d(occupied, before) if self.vectorized else \
+            occupied
+        grid.empties.update(self._coords(freed))
+        grid.empties.difference_update(self._coords(taken))
+        self._occupied = occupied
+        if self.vectorized:
+            self.pos[:] = pos
+        else:
+            for a, xy in zip(self.ants, pos.tolist()):
+                a.pos = tuple(xy)
+
+    def _coords(self, cells):
+        x, y = divmod(cells, self._grid.height)
+        return zip(x.tolist(), y.tolist())
+
+    def get_state(self, ledger_tail=LEDGER_TAIL):
+        """Everything needed to rebuild the model, as a JSON-able dict of
+        scalars and RNG states plus a dict of arrays. Of the ledger, only
+        the last `ledger_tail` trades and the pairs of goods index are
+        kept."""
+        if self.vectorized:
+            arrays = {name: getattr(self, name) for name in AGENT_ARRAYS}
+            if self.goods is not None:
+                arrays["goods"] = self.goods
+            rngs = {a.unique_id: a._rng.bit_generator.state
+                    for a in self.ants if a._rng is not None}
+        else:
+            arrays = {name: np.array([getattr(a, name) for a in self.ants])
+                      for name in AGENT_ARRAYS + ("age", "trades_done")}
+            rngs = {a.unique_id: a.rng.bit_generator.state
+                    for a in self.ants}
+        arrays["pos"] = self.positions()
+        ledger = self.ledger
+        for name, values in ledger.tail(ledger_tail).items():
+            arrays["ledger_" + name] = values
+        arrays["ledger_pair_trade"] = ledger.pair_trade
+        arrays["ledger_pair_price"] = ledger.pair_price
+        meta = {name: getattr(self, name) for name in FLAGS}
+        meta.update(
+            N=self.N, K=self.K,
+            width=self._grid.width, height=self._grid.height,
+            vectorized=self.vectorized, spread=self.spread,
+            compact=self.compact, dtype=self.dtype.name, top_k=self.top_k,
+            collector=("array" if isinstance(self.datacollector,
+                                             ArrayCollector) else "mesa"),
+            seed=self.streams.seed.entropy,
+            steps=self.schedule.steps, time=self.schedule.time,
+            ledger={"capacity": ledger.capacity, "chunk": ledger.chunk,
+                    "count": ledger.count},
+            random=self.random.getstate(),
+            rngs=rngs,
+            tallies={})
+        for name in ("utility_stats", "spec_stats"):
+            tally = getattr(self, name)
+            arrays[name] = tally.values
+            meta["tallies"][name] = [tally.total,
+                                     getattr(tally, "squares", 0.),
+                                     tally.updates]
+        return meta, arrays
+
+    @classmethod
+    def from_state(cls, meta, arrays, ledger_spill=None):
+        """Rebuild a model from the output of get_state. Its ledger spills
+        to `ledger_spill` if given, never to the original's directory,
+        which the original may still be writing to."""
+        ledger = meta["ledger"]
+        model = cls(meta["N"], meta["K"], meta["width"], meta["height"],
+                    meta["trade"], meta["vectorized"],
+                    ledger_size=ledger["capacity"],
+                    ledger_spill=ledger_spill, seed=meta["seed"],
+                    spread=meta["spread"], collector=meta["collector"],
+                    compact=meta.get("compact", False),
+                    dtype=meta.get("dtype", "float64"),
+                    top_k=meta.get("top_k"))
+        for name in FLAGS:
+            # flags added since a checkpoint was written keep their default
+            setattr(model, name, meta.get(name, getattr(model, name)))
+        model.schedule.steps = meta["steps"]
+        model.schedule.time = meta["time"]
+        version, state, gauss = meta["random"]
+        model.random.setstate((version, tuple(state), gauss))
+        if model.vectorized:
+            for name in AGENT_ARRAYS:
+                setattr(model, name, arrays[name])
+            if model.top_k is not None:
+                model.goods = arrays["goods"]
+        else:
+            for a in model.ants:
+                # arrays are filled in place, as they may be views of
+                # the model's buffer
+                for name in AGENT_ARRAYS + ("age", "trades_done"):
+                    if name in ANT_ROWS:
+                        getattr(a, name)[:] = arrays[name][a.unique_id]
+                    else:
+                        setattr(a, name, arrays[name][a.unique_id].item())
+                a.prices[:] = a.ppf[0] / a.ppf
+                a.specialization = kernels.specialization(a.prod_plan)
+                a.touch()
+        for unique_id, state in meta["rngs"].items():
+            model.ants[int(unique_id)].rng.bit_generator.state = state
+        model.place_all(np.asarray(arrays["pos"]))
+        model.ledger.chunk = ledger["chunk"]
+        model.ledger.restore(
+            {name: arrays["ledger_" + name]
+             for name in ("step", "initiator", "partner", "goods")},
+            ledger["count"], arrays.get("ledger_pair_trade"),
+            arrays.get("ledger_pair_price"))
+        # carry the running totals over as they were, rather than
+        # resumming, so the means match the original to the last bit
+        for name, (total, squares, updates) in meta["tallies"].items():
+            tally = getattr(model, name)
+            tally.values[:] = arrays[name]
+            tally.total, tally.squares, tally.updates = \
+                total, squares, updates
+        model.dirty.clear()
+        model.update_means()
+        return model
+
+    def save_checkpoint(self, path):
+        """Write the whole model state to the directory `path`"""
+        checkpoint.write_state(path, *self.get_state())
+
+    @classmethod
+    def load_checkpoint(cls, path, ledger_spill=None):
+        """Rebuild a model saved with save_checkpoint. The agent arrays
+        are memory-mapped copy-on-write rather than read in."""
+        return cls.from_state(*checkpoint.read_state(path), ledger_spill)
+
+    def fork(self, ledger_spill=None):
+        """An independent copy of this model, e.g. to branch several
+        scenarios off one burn-in, spilling its trades to `ledger_spill`
+        if given. ppf and u_params (and a sparse model's
+        goods) rarely change during a run, so the vectorized engine gives
+        the fork and the original copy-on-write copies of them
+        (checkpoint.shared_copies) rather than a copy each. Either can
+        still write to its own."""
+        meta, arrays = self.get_state()
+        meta = copy.deepcopy(meta)
+        for name, values in arrays.items():
+            if self.vectorized and self.workers is None and \
+                    name in ("ppf", "u_params", "goods"):
+                mine, arrays[name] = checkpoint.shared_copies(values)
+                setattr(self, name, mine)
+            else:
+                arrays[name] = values.copy()
+        return self.from_state(meta, arrays, ledger_spill)
+
+    def init_arrays(self):
+        """Draw agent state for the whole population at once, with the
+        same distributions ant.__init__ uses. With top_k each agent first
+        draws its k goods, and the rest is drawn for those alone."""
+        N, K = self.N, self.K
+        if self.top_k is not None:
+            self.goods = kernels.draw_goods(
+                N, K, self.top_k, (self.streams.rows("goods", attempt)
+                                   for attempt in itertools.count()))
+            K = self.top_k
+        draws = self.streams.rows("init").integers(1, 4, (N, 2, K))
+        self.ppf = draws[:, 0].astype(self.dtype)
+        self.endowment = 10 * self.ppf
+        self.prod_plan = np.full((N, K), 1. / K, self.dtype)
+        u_params = draws[:, 1]
+        self.u_params = (u_params / u_params.sum(axis=1, keepdims=True)
+                         ).astype(self.dtype)
+        self.learning_rate = np.full(N, 0.05, self.dtype)
+        self.pos = np.zeros((N, 2), dtype=int)
 
     def step(self):
-        self.schedule.step()
-        self.datacollector.collect(self)
-        all_utility = [agent.utility() for agent in self.schedule.agents]
-        self.mean_utility = sum(all_utility) / self.N
-        all_spec = [agent.specialization() for agent in self.schedule.agents]
-        self.mean_specialization = np.mean(all_spec) / self.N
+        self.advance()
+        with self.profile.phase("collect"):
+            self.datacollector.collect(self)
+
+    def advance(self):
+        """A step without data collection"""
+        if self.money:
+            self.market.open()
+        if self.vectorized:
+            self.vector_step()
+        else:
+            self.schedule.step()
+        if self.money:
+            self.market.close()
+        with self.profile.phase("update_means"):
+            self.update_means()
+        self.profile.end_step(self)
+        if self.convergence is not None:
+            self.convergence.update(self)
+
+    def positions(self):
+        """N x 2 array of agent positions"""
+        if self.vectorized:
+            return self.pos
+        return np.array([a.pos for a in self.ants])
+
+    def vector_step(self):
+        """Step every agent at once, one batched operation per phase."""
+        if self.workers is not None:
+            return self.workers.vector_step()
+        step = self.schedule.steps
+        profile = self.profile
+        with profile.phase("move"):
+            kernels.move(self.pos, self._grid.width, self._grid.height,
+                         self.streams.rows("move", step))
+            self._grid_stale = True
+        with profile.phase("produce"):
+            kernels.produce(self.endowment, self.prod_plan, self.ppf)
+        if self.trade and self.money:
+            if self.goods is not None:
+                raise ValueError("money mode needs every agent to deal "
+                                 "in every good (no top_k)")
+            with profile.phase("trade"):
+                order = self.streams.phase("match", step).permutation(self.N)
+                self.market.post(order.tolist(), self.endowment[order],
+                                 self.prod_plan[order], self.ppf[order],
+                                 self.u_params[order])
+        elif self.trade:
+            with profile.phase("match"):
+                partner = self.match(step)
+            with profile.phase("trade"):
+                if self.goods is None:
+                    scale = kernels.trade(
+                        self.endowment, self.prod_plan, self.ppf,
+                        self.learning_rate, ledger=self.ledger, step=step,
+                        partner=partner)
+                else:
+                    scale = kernels.sparse_trade(
+                        self.goods, self.K, self.endowment, self.prod_plan,
+                        self.ppf, partner)
+            profile.count_halvings(scale)
+        if self.consume:
+            with profile.phase("consume"):
+                kernels.consume(self.endowment, self.u_params, self.units,
+                                self.streams.rows("consume", step))
+        if self.solo_update:
+            with profile.phase("solo_update"):
+                kernels.solo_update(self.prod_plan, self.u_params,
+                                    self.learning_rate)
+        self.schedule.steps += 1
+        self.schedule.time += 1
+
+    def match(self, step):
+        """Every agent's trading partner for `step` in the vectorized
+        engine: anyone (kernels.match) or, with `local` set, a neighbour"""
+        rng = self.streams.phase("match", step)
+        if not self.local:
+            return kernels.match(self.N, self.self_trade, rng)
+        groups, n_groups = kernels.trade_groups(
+            self.pos, self._grid.width, self._grid.height, self.local, rng)
+        partner = kernels.local_match(groups, n_groups, rng)
+        if self.profile.enabled:
+            self.profile.count("partner_misses", int(
+                (partner == np.arange(self.N)).sum()))
+        return partner
+
+    def update_means(self):
+        """Bring the utility and specialization tallies up to date.
+        The per-agent path only revisits agents that were touched; the
+        vectorized engine changes every row, so it recomputes in one go."""
+        if self.goods is not None:
+            self.utility_stats.replace(
+                kernels.sparse_utility(self.endowment, self.u_params,
+                                       self.K))
+            self.spec_stats.replace(kernels.specialization(self.prod_plan))
+        elif self.workers is not None:
+            # worked out by the workers at the end of the step
+            self.utility_stats.replace(self.workers.utility)
+            self.spec_stats.replace(self.workers.specialization)
+        elif self.vectorized:
+            self.utility_stats.replace(
+                kernels.utility(self.endowment, self.u_params))
+            self.spec_stats.replace(kernels.specialization(self.prod_plan))
+        elif self.dirty:
+            ids = np.fromiter(self.dirty, dtype=int)
+            self.utility_stats.update(
+                ids, [self.ants[i].utility() for i in ids])
+            self.spec_stats.update(
+                ids, [self.ants[i].specialization for i in ids])
+        self.dirty.clear()
+        self.mean_utility = self.utility_stats.mean
+        self.mean_specialization = self.spec_stats.mean
+        if self.spread:
+            for name, stats in (("utility", self.utility_stats),
+                                ("specialization", self.spec_stats)):
+                setattr(self, "var_" + name, stats.var)
+                setattr(self, "min_" + name, stats.min)
+                setattr(self, "max_" + name, stats.max)
 
 
 class exchange():
     """A contract between two agents where each partner is giving a
     vector of goods to the other during the current time step."""
+    __slots__ = ("partners", "goods", "model", "delta")
+
     def __init__(self, partners, model, goods=False):
-        if not goods:
-            goods = [np.zeros(model.K), np.zeros(model.K)]
         self.partners = partners  # Note: this should have two elements
         # Although I could allow n partners as long as each has an associated
         # n-1 vectors for goods.
-        self.goods = goods
+        # goods[0] is what partners[0] gives, goods[1] what it gets. The
+        # trade methods fill them in place rather than allocating anew.
+        self.goods = np.zeros((2, model.K), model.dtype)
         self.model = model
-        self.delta = self.goods[0] - self.goods[1]
+        if goods:
+            self.goods[:] = goods
+            self.delta = self.goods[0] - self.goods[1]
+        else:
+            self.delta = None  # all zeros
 
     def undertake(self, update=True):
         p0 = self.partners[0]
@@ -174,36 +698,42 @@ class exchange():
         p0.endowment += self.goods[1]
         p1.endowment -= self.goods[1]
         p1.endowment += self.goods[0]
-        if update:
+        p0.touch()
+        p1.touch()
+        if update and self.delta is not None:
             p0.prod_plan += self.delta * p0.learning_rate
             p1.prod_plan -= self.delta * p1.learning_rate
-        self.model.history.append(self)
+        # as in kernels.trade, only trades that moved goods between two
+        # agents go in the ledger
+        if p0 is p1 or not self.goods.any():
+            return
+        self.model.ledger.append(self.model.schedule.steps,
+                                 p0.unique_id, p1.unique_id,
+                                 self.goods[0], self.goods[1])
 
     def day_trade(self):
         part0 = self.partners[0]
         part1 = self.partners[1]
-        give = part0.prod_plan * part0.ppf
-        take = part1.prod_plan * part1.ppf
-        while not (part0.has(give) and part1.has(take)):
-            give *= 0.5
-            take *= 0.5
-        self.goods = [give, take]
+        give, take = self.goods
+        np.multiply(part0.prod_plan, part0.ppf, out=give)
+        np.multiply(part1.prod_plan, part1.ppf, out=take)
+        # Scale down by halves until both sides can afford it
+        scale = kernels.feasible_scale(part0.endowment, give,
+                                       part1.endowment, take)
+        self.model.profile.count_halvings(scale)
+        self.goods *= scale
         return self
 
     def hist_trade(self, involving=None):
-        history = self.model.history
-        if involving:
-            keep1 = history["partners"].has(involving)
-            history = history[keep1]
+        # involving may be an agent, as in the original, or its id
+        involving = getattr(involving, "unique_id", involving)
+        goods = self.model.ledger.sample(involving, self.partners[0].rng)
         # maybe randomly flip direction?
-        goods = np.random.choice(history["goods"])
-        self.goods = goods
+        if goods is not None:
+            self.goods[:] = goods
         return self
 
     def rand_trade(self):
-        goods = [
-            np.random.randint(-2, 2, self.model.K),
-            np.random.randint(-2, 2, self.model.K)
-        ]
-        self.goods = goods
+        self.goods[0] = self.partners[0].rng.integers(-2, 2, self.model.K)
+        self.goods[1] = self.partners[0].rng.integers(-2, 2, self.model.K)
         return self
@@ -0,0 +1,251 @@
+"""
+Step one large vectorized mkt with several worker processes.
+
+    from parallel import Workers
+    model = mkt(1000000, 5, vectorized=True, seed=1)
+    with Workers(model, 8):
+        for _ in range(100):
+            model.step()
+
+While the workers run, the agent arrays live in shared memory blocks
+(multiprocessing.shared_memory), which the model and every worker map
+without copying. Each worker owns a contiguous slice of rows starting on a
+streams.BLOCK boundary, so its draws are exactly the ones a serial run
+makes for those rows. A step is up to three rounds, each finished by every
+worker before the next starts:
+
+    1. move and produce, each worker on its own rows
+    2. trade: the main process matches the whole population as
+       vector_step does, then each worker sizes the trades its rows start,
+       reading partners' rows wherever they are, and writes what each
+       side hands over to the shared give and take buffers
+    3. each worker settles its rows: the trades they started, and the
+       ones they were the partner in, whose amounts come from the buffers
+       (so a trade across slices is no different from one within a
+       slice); then consume, solo_update, and the utility and
+       specialization the model's tallies need
+
+Every element goes through the same floating point operations in the same
+order as in vector_step, so the results are bit-identical to a serial run
+whatever the number of workers. The main process fills the ledger from the
+buffers after round 2. With profiling on, round 1 is timed as produce and
+round 3 as consume.
+
+Money mode and top_k are not supported.
+"""
+import os
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import kernels
+from streams import BLOCK, Streams
+
+# Agent arrays moved into shared memory while the workers run
+SHARED = ("ppf", "endowment", "prod_plan", "u_params", "learning_rate",
+          "pos")
+
+
+class Workers():
+    """Worker processes stepping slices of `model`'s agents; sets
+    model.workers until closed"""
+    def __init__(self, model, workers=None):
+        if not model.vectorized:
+            raise ValueError("parallel stepping needs vectorized=True")
+        if model.goods is not None:
+            raise ValueError("parallel stepping doesn't support top_k")
+        N, K = model.N, model.K
+        n_blocks = -(-N // BLOCK)
+        workers = max(1, min(workers or os.cpu_count(), n_blocks))
+        edges = np.linspace(0, n_blocks, workers + 1).round().astype(int)
+        edges = np.minimum(edges * BLOCK, N)
+        self.bounds = list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+        self.model = model
+        self._blocks = []
+        self._specs = {}
+        for name in SHARED:
+            values = getattr(model, name)
+            shared = self._share(name, values.shape, values.dtype)
+            shared[:] = values
+            setattr(model, name, shared)
+        self.give = self._share("give", (N, K), model.dtype)
+        self.take = self._share("take", (N, K), model.dtype)
+        self.scale = self._share("scale", (N,), np.float64)
+        self.partner = self._share("partner", (N,), np.int64)
+        self.inverse = self._share("inverse", (N,), np.int64)
+        self.utility = self._share("utility", (N,), model.dtype)
+        self.specialization = self._share("specialization", (N,),
+                                          model.dtype)
+        self.utility[:] = kernels.utility(model.endowment, model.u_params)
+        self.specialization[:] = kernels.specialization(model.prod_plan)
+        context = get_context("spawn")
+        self.conns = []
+        self.processes = []
+        for lo, hi in self.bounds:
+            conn, child = context.Pipe()
+            process = context.Process(
+                target=_serve,
+                args=(child, self._specs, lo, hi,
+                      model.streams.seed.entropy),
+                daemon=True)
+            process.start()
+            child.close()
+            self.conns.append(conn)
+            self.processes.append(process)
+        model.workers = self
+
+    def _share(self, name, shape, dtype):
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape, dtype=int)) * dtype.itemsize
+        block = SharedMemory(create=True, size=max(size, 1))
+        self._blocks.append(block)
+        self._specs[name] = (block.name, shape, dtype.str)
+        return np.ndarray(shape, dtype, buffer=block.buf)
+
+    def run(self, name, *args):
+        """One round: every worker runs `name` on its rows"""
+        try:
+            for conn in self.conns:
+                conn.send((name, args))
+            errors = [conn.recv() for conn in self.conns]
+        except (EOFError, OSError):
+            raise RuntimeError("a worker process died") from None
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def vector_step(self):
+        """mkt.vector_step, with the work on agent rows done by the
+        workers"""
+        model = self.model
+        if model.trade and model.money:
+            raise ValueError("parallel stepping doesn't support money mode")
+        step = model.schedule.steps
+        profile = model.profile
+        with profile.phase("produce"):
+            self.run("first", step, model._grid.width, model._grid.height)
+        model._grid_stale = True
+        if model.trade:
+            with profile.phase("match"):
+                partner = model.match(step)
+            with profile.phase("trade"):
+                self.partner[:] = partner
+                self.inverse[partner] = np.arange(model.N)
+                self.run("trade")
+                a = np.arange(model.N)
+                done = (self.scale > 0) & (a != partner)
+                model.ledger.extend(step, a[done], partner[done],
+                                    self.give[done], self.take[done])
+            profile.count_halvings(self.scale)
+        with profile.phase("consume"):
+            self.run("last", step, bool(model.trade), model.consume,
+                     model.units, model.solo_update)
+        model.schedule.steps += 1
+        model.schedule.time += 1
+
+    def close(self):
+        """Stop the workers and give the model back private copies of its
+        arrays"""
+        if self.model.workers is not self:
+            return
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except OSError:
+                pass  # already gone
+        for process in self.processes:
+            process.join()
+        for conn in self.conns:
+            conn.close()
+        model = self.model
+        model.workers = None
+        for name in SHARED:
+            setattr(model, name, np.array(getattr(model, name)))
+        self.give = self.take = self.scale = self.partner = None
+        self.inverse = self.utility = self.specialization = None
+        for block in self._blocks:
+            block.unlink()
+            try:
+                block.close()
+            except BufferError:
+                pass  # someone still holds a view; unmapped when it goes
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _first(arrays, lo, hi, streams, step, width, height):
+    rows = slice(lo, hi)
+    kernels.move(arrays["pos"][rows], width, height,
+                 streams.rows("move", step, lo))
+    kernels.produce(arrays["endowment"][rows], arrays["prod_plan"][rows],
+                    arrays["ppf"][rows])
+
+
+def _trade(arrays, lo, hi, streams):
+    """kernels.trade up to the point where endowments change"""
+    rows = slice(lo, hi)
+    b = arrays["partner"][rows]
+    endowment = arrays["endowment"]
+    give = arrays["prod_plan"][rows] * arrays["ppf"][rows]
+    take = arrays["prod_plan"][b] * arrays["ppf"][b]
+    scale = kernels.feasible_scale(endowment[rows] / 2, give,
+                                   endowment[b] / 2, take)
+    give *= scale[:, None]
+    take *= scale[:, None]
+    arrays["give"][rows] = give
+    arrays["take"][rows] = take
+    arrays["scale"][rows] = scale
+
+
+def _last(arrays, lo, hi, streams, step, traded, consume, units,
+          solo_update):
+    rows = slice(lo, hi)
+    endowment = arrays["endowment"][rows]
+    prod_plan = arrays["prod_plan"][rows]
+    u_params = arrays["u_params"][rows]
+    if traded:
+        give, take = arrays["give"], arrays["take"]
+        endowment -= give[rows] - take[rows]
+        # the trade each row was the partner in
+        a = arrays["inverse"][rows]
+        endowment += give[a] - take[a]
+    if consume:
+        kernels.consume(endowment, u_params, units,
+                        streams.rows("consume", step, lo))
+    if solo_update:
+        kernels.solo_update(prod_plan, u_params,
+                            arrays["learning_rate"][rows])
+    arrays["utility"][rows] = kernels.utility(endowment, u_params)
+    arrays["specialization"][rows] = kernels.specialization(prod_plan)
+
+
+ROUNDS = {"first": _first, "trade": _trade, "last": _last}
+
+
+def _serve(conn, specs, lo, hi, seed):
+    """A worker: map the shared arrays, then run rounds until told to
+    stop"""
+    blocks = {name: SharedMemory(name=block)
+              for name, (block, shape, dtype) in specs.items()}
+    arrays = {name: np.ndarray(shape, np.dtype(dtype),
+                               buffer=blocks[name].buf)
+              for name, (block, shape, dtype) in specs.items()}
+    streams = Streams(seed)
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        name, args = message
+        try:
+            ROUNDS[name](arrays, lo, hi, streams, *args)
+            conn.send(None)
+        except Exception as error:
+            conn.send(error)
+    arrays.clear()
+    for block in blocks.values():
+        block.close()
+    conn.close()
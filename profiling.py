@@ -0,0 +1,149 @@
+"""
+Optional per-phase timing and counters for mkt.
+
+    model = mkt(1000, 5, profile=True)
+    for _ in range(100):
+        model.step()
+    model.profile.summary()
+
+With profiling on, each step sets model.time_<phase> to the seconds spent
+in that phase during the step, and model.halvings, model.partner_misses
+and model.ledger_size to the step's counts. These are added to the
+model reporters, so they show up in the data collector and can be
+charted. Collection itself is timed too, but since it happens after the
+other reporters are read, time_collect is the previous step's.
+
+With profiling off the model holds OFF, whose hooks do nothing, so the
+cost is one no-op call per phase.
+"""
+import time
+from collections import defaultdict
+import numpy as np
+
+# Phases timed by each engine, in the order they run
+AGENT_PHASES = ("move", "produce", "find_partner", "day_trade", "undertake",
+                "market", "consume", "solo_update", "update_means",
+                "collect")
+VECTOR_PHASES = ("move", "produce", "match", "trade", "consume",
+                 "solo_update", "update_means", "collect")
+COUNTERS = ("halvings", "partner_misses", "infeasible_trades")
+
+
+def reporters(vectorized):
+    """Model reporters for the profile: label -> model attribute"""
+    phases = VECTOR_PHASES if vectorized else AGENT_PHASES
+    names = {"Time_" + phase: "time_" + phase for phase in phases}
+    names.update(Halvings="halvings", Partner_Misses="partner_misses",
+                 Ledger_Size="ledger_size")
+    return names
+
+
+class _Timer():
+    """Context manager adding the time spent inside it to one phase"""
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.profile.step_times[self.name] += elapsed
+        self.profile.calls[self.name] += 1
+
+
+class Profile():
+    """Wall-clock time and call count per phase, plus counts of trade
+    halvings, failed partner searches and trades that couldn't be made
+    affordable, both per step and for the whole run."""
+    enabled = True
+
+    def __init__(self, vectorized=False):
+        self.phases = VECTOR_PHASES if vectorized else AGENT_PHASES
+        self.timers = {name: _Timer(self, name) for name in self.phases}
+        self.step_times = defaultdict(float)
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.step_counts = defaultdict(int)
+        self.counts = defaultdict(int)
+        self.steps = 0
+        self.started = time.perf_counter()
+
+    def phase(self, name):
+        return self.timers[name]
+
+    def count(self, name, n=1):
+        self.step_counts[name] += n
+
+    def count_halvings(self, scale):
+        """Tally the halvings behind trade scales 2 ** -n, and the trades
+        with scale 0, which the halving loop could never make affordable"""
+        scale = np.asarray(scale)
+        ok = scale > 0
+        self.step_counts["halvings"] += int(-np.log2(scale[ok]).sum())
+        self.step_counts["infeasible_trades"] += int((~ok).sum())
+
+    def end_step(self, model):
+        """Fold this step's numbers into the totals and set the reporter
+        attributes on model"""
+        self.steps += 1
+        for name in self.phases:
+            seconds = self.step_times[name]
+            self.times[name] += seconds
+            setattr(model, "time_" + name, seconds)
+        # collect runs after this, so its time is carried into the next step
+        self.step_times.clear()
+        for name in COUNTERS:
+            self.counts[name] += self.step_counts[name]
+            setattr(model, name, self.step_counts[name])
+        self.step_counts.clear()
+        model.ledger_size = model.ledger.count
+
+    def summary(self):
+        """Totals for the run so far, as a plain dict"""
+        elapsed = time.perf_counter() - self.started
+        times = dict(self.times)
+        times["collect"] = times.get("collect", 0.) + \
+            self.step_times["collect"]
+        return {"steps": self.steps,
+                "seconds": elapsed,
+                "steps_per_sec": self.steps / elapsed if elapsed else 0.,
+                "phases": {name: {"seconds": times.get(name, 0.),
+                                  "calls": self.calls[name],
+                                  "per_step": (times.get(name, 0.) /
+                                               max(self.steps, 1))}
+                           for name in self.phases},
+                **{name: self.counts[name] for name in COUNTERS}}
+
+
+class _NoTimer():
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+class _Off():
+    """Stands in for a Profile when profiling is off"""
+    enabled = False
+    _timer = _NoTimer()
+
+    def phase(self, name):
+        return self._timer
+
+    def count(self, name, n=1):
+        pass
+
+    def count_halvings(self, scale):
+        pass
+
+    def end_step(self, model):
+        pass
+
+    def summary(self):
+        return {}
+
+
+OFF = _Off()
@@ -1,4 +1,29 @@
-from server import server
+import argparse
 
-server.port = 8521  # The default
-server.launch()
+parser = argparse.ArgumentParser()
+parser.add_argument("--live", action="store_true",
+                    help="step in the background and stream changes")
+parser.add_argument("--jobs", action="store_true",
+                    help="serve the HTTP/JSON job API")
+parser.add_argument("--N", type=int, default=1000)
+parser.add_argument("--K", type=int, default=2)
+parser.add_argument("--vectorized", action="store_true")
+parser.add_argument("--fps", type=float, default=10)
+parser.add_argument("--workers", type=int,
+                    help="worker processes for --jobs (default: all cores)")
+parser.add_argument("--port", type=int)
+
+# job worker processes import this module again; only launch once
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.jobs:
+        from jobs import serve
+        serve(port=args.port or 8523, workers=args.workers)
+    elif args.live:
+        from live import serve
+        serve(port=args.port or 8522, fps=args.fps, N=args.N, K=args.K,
+              vectorized=args.vectorized)
+    else:
+        from server import server
+        server.port = args.port or 8521  # The default
+        server.launch()
@@ -2,6 +2,7 @@ from mesa.visualization.modules import CanvasGrid, ChartModule, TextElement
 from mesa.visualization.ModularVisualization import ModularServer
 from mesa.visualization.UserParam import UserSettableParameter
 from model import mkt
+from profiling import AGENT_PHASES
 
 
 class UtilityElement(TextElement):
@@ -27,20 +28,25 @@ model_params = {
                                "Number of agents",
                                value=50,
                                min_value=2,
-                               max_value=100,
+                               max_value=100000,
                                step=1),
     "K": UserSettableParameter("slider",
                                "Number of goods",
                                value=2,
                                min_value=2,
-                               max_value=10,
+                               max_value=1000,
                                step=1),
     "width": 10,
     "height": 10,
     "trade": UserSettableParameter("choice",
                                    "Allow trade?",
                                    value=True,
-                                   choices=[True, False])
+                                   choices=[True, False]),
+    "vectorized": UserSettableParameter("choice",
+                                        "Step all agents at once?",
+                                        value=False,
+                                        choices=[True, False]),
+    "profile": True
 }
 
 utility_element = UtilityElement()
@@ -51,10 +57,17 @@ utility_chart = ChartModule([{"Label": "Mean_Utility",
 specialization_chart = ChartModule([{"Label": "Mean_Specialization",
                                      "Color": "Green"}],
                                    data_collector_name='datacollector')
+# The vectorized engine's match and trade phases have no line here
+colors = ["Red", "Orange", "Gold", "Green", "Teal", "Blue", "Purple",
+          "Brown", "Gray", "Black"]
+timing_chart = ChartModule([{"Label": "Time_" + phase, "Color": color}
+                            for phase, color in zip(AGENT_PHASES, colors)],
+                           data_collector_name='datacollector')
 server = ModularServer(mkt,
                        [grid,
                         utility_chart,
                         specialization_chart,
+                        timing_chart,
                         utility_element],
                        "Money Model",
                        model_params)
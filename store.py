@@ -0,0 +1,184 @@
+"""
+An append-only, memory-mapped store of a run's results, for runs whose
+agent-level series don't fit in memory.
+
+    model = mkt(100000, 5, vectorized=True)
+    model.datacollector = ResultStore("run1", model, params={"seed": 1})
+    for _ in range(100000):
+        model.step()
+    model.datacollector.close()
+
+    run = open_store("run1")  # also while the run is still going
+    run.view("Utility", steps=slice(-100, None), agents=slice(0, 10))
+
+Each metric is one raw file of rows, a row per collected step: a value per
+agent for Utility and Specialization, and a single value for Step and the
+model reporters. The files are memory-mapped for writing and grown by
+doubling (extending a file doesn't copy it), so appending a step costs the
+same however long the run has been going. header.json holds N, K, the
+params and the metrics, and is rewritten only when the files grow and at
+the end. How many rows are filled is an 8-byte counter in rows.dat,
+mapped by writer and readers alike; the writer bumps it after each row is
+written, so a reader never counts a row that isn't there yet. Readers map
+the files read-only and view() slices those maps, so reading copies
+nothing.
+"""
+import json
+import os
+import numpy as np
+from collector import AGENT_VARS
+
+HEADER = "header.json"
+COUNT = "rows"
+
+
+def _file(path, name):
+    return os.path.join(path, name + ".dat")
+
+
+def _map(path, name, width, dtype, mode):
+    """The whole of a metric's file as a rows x width memmap"""
+    dtype = np.dtype(dtype)
+    rows = os.path.getsize(_file(path, name)) // (width * dtype.itemsize)
+    return np.memmap(_file(path, name), dtype, mode, shape=(rows, width))
+
+
+class ResultStore():
+    """Writes a run to the directory `path`, collecting like
+    ArrayCollector (set it as model.datacollector)"""
+    def __init__(self, path, model, params=None, model_reporters=None,
+                 every=1, rows=1024, dtype=np.float64):
+        if model_reporters is None:
+            model_reporters = {"Mean_Utility": "mean_utility",
+                               "Mean_Specialization": "mean_specialization"}
+        self.path = path
+        self.model_reporters = model_reporters
+        self.every = every
+        dtype = np.dtype(dtype).str
+        self.metrics = {"Step": (1, np.dtype(np.int64).str)}
+        self.metrics.update({name: (model.N, dtype) for name in AGENT_VARS})
+        self.metrics.update({name: (1, dtype) for name in model_reporters})
+        self.header = {"N": model.N, "K": model.K, "params": params or {},
+                       "every": every, "metrics": self.metrics,
+                       "rows": 0, "closed": False}
+        os.makedirs(path, exist_ok=True)
+        self.count = np.memmap(_file(path, COUNT), np.int64, "w+",
+                               shape=(1,))
+        self.rows = 0
+        self.capacity = 0
+        self.maps = {}
+        self._grow(rows)
+
+    def _grow(self, capacity):
+        for name, (width, dtype) in self.metrics.items():
+            self.maps.pop(name, None)
+            with open(_file(self.path, name), "ab") as f:
+                f.truncate(capacity * width * np.dtype(dtype).itemsize)
+            self.maps[name] = _map(self.path, name, width, dtype, "r+")
+        self.capacity = capacity
+        self._write_header()
+
+    def _write_header(self):
+        self.header["rows"] = self.rows
+        temp = os.path.join(self.path, HEADER + ".tmp")
+        with open(temp, "w") as f:
+            json.dump(self.header, f)
+        os.replace(temp, os.path.join(self.path, HEADER))
+
+    def collect(self, model):
+        step = model.schedule.steps
+        if step % self.every:
+            return
+        if self.rows == self.capacity:
+            self._grow(2 * self.capacity)
+        row = self.rows
+        self.maps["Step"][row, 0] = step
+        for name, attr in AGENT_VARS.items():
+            self.maps[name][row] = getattr(model, attr).values
+        for name, attr in self.model_reporters.items():
+            self.maps[name][row, 0] = getattr(model, attr)
+        self.rows += 1
+        self.count[0] = self.rows
+
+    def view(self, name):
+        """Steps x width array of `name` so far (a view of the map)"""
+        return self.maps[name][:self.rows]
+
+    def close(self):
+        """Flush the maps to disk and mark the run as finished"""
+        for values in self.maps.values():
+            values.flush()
+        self.count.flush()
+        self.header["closed"] = True
+        self._write_header()
+
+    def get_model_vars_dataframe(self):
+        import pandas as pd  # only needed here; slow to import
+        return pd.DataFrame({name: self.view(name)[:, 0]
+                             for name in self.model_reporters})
+
+    def get_agent_vars_dataframe(self):
+        """Every row, indexed like Mesa's (Step, AgentID). This one is
+        read into memory."""
+        import pandas as pd
+        index = pd.MultiIndex.from_product(
+            [self.view("Step")[:, 0], np.arange(self.header["N"])],
+            names=["Step", "AgentID"])
+        return pd.DataFrame({name: self.view(name).ravel()
+                             for name in AGENT_VARS}, index=index)
+
+
+class StoreReader():
+    """A run written by ResultStore, finished or not"""
+    def __init__(self, path):
+        self.path = path
+        self.maps = {}
+        self.count = np.memmap(_file(path, COUNT), np.int64, "r",
+                               shape=(1,))
+        self.refresh()
+
+    def refresh(self):
+        """Catch up with the writer; returns the number of rows"""
+        self.rows = int(self.count[0])
+        with open(os.path.join(self.path, HEADER)) as f:
+            self.header = json.load(f)
+        self.N = self.header["N"]
+        self.K = self.header["K"]
+        self.params = self.header["params"]
+        for name, (width, dtype) in self.header["metrics"].items():
+            values = self.maps.get(name)
+            if values is None or len(values) < self.rows:
+                self.maps[name] = _map(self.path, name, width, dtype, "r")
+        return self.rows
+
+    @property
+    def closed(self):
+        return self.header["closed"]
+
+    @property
+    def metrics(self):
+        return list(self.header["metrics"])
+
+    @property
+    def steps(self):
+        """The step number of each row"""
+        return self.maps["Step"][:self.rows, 0]
+
+    def view(self, name, steps=slice(None), agents=slice(None)):
+        """Rows `steps` (a slice of rows) of metric `name`, for agents
+        `agents` (a slice). Model-level metrics have a single column,
+        which is dropped."""
+        values = self.maps[name][:self.rows][steps]
+        if values.shape[1] == 1 and self.N != 1:
+            return values[:, 0]
+        return values[:, agents]
+
+    def rows_between(self, first, last):
+        """The slice of rows collected at steps first..last inclusive"""
+        steps = self.steps
+        return slice(int(np.searchsorted(steps, first)),
+                     int(np.searchsorted(steps, last, side="right")))
+
+
+def open_store(path):
+    return StoreReader(path)
@@ -0,0 +1,81 @@
+"""
+Independent random number streams for one model run.
+
+Every random draw in a run comes from a numpy Generator derived from the
+run's seed with SeedSequence, keyed by what it is for: a phase at a given
+step, a fixed block of agents within that phase, or a single agent. The
+numbers any agent sees therefore depend only on the seed, the phase, the
+step and the agent's id, never on which thread or process stepped it.
+"""
+import random
+import numpy as np
+
+# Agents are grouped into blocks of this many rows for batched draws.
+# Partitions of the population that start on a block boundary get exactly
+# the numbers a serial run would.
+BLOCK = 1024
+PHASES = {"init": 0, "match": 1, "consume": 2, "move": 3, "history": 4,
+          "python": 5, "agent": 6, "collect": 7, "place": 8, "goods": 9}
+
+
+class Streams():
+    def __init__(self, seed=None):
+        self.seed = np.random.SeedSequence(seed)
+
+    def sequence(self, name, *key):
+        """The SeedSequence for phase `name` and the rest of `key`"""
+        return np.random.SeedSequence(
+            self.seed.entropy,
+            spawn_key=self.seed.spawn_key + (PHASES[name],) + key)
+
+    def generator(self, name, *key):
+        return np.random.Generator(np.random.PCG64(self.sequence(name, *key)))
+
+    def phase(self, name, step=0):
+        """Generator for population-wide draws (e.g. matching) in a step"""
+        return self.generator(name, step)
+
+    def agent(self, unique_id):
+        """An agent's own generator, used by the per-agent path"""
+        return self.generator("agent", unique_id)
+
+    def python(self):
+        """A seeded random.Random for Mesa's schedule and grid"""
+        return random.Random(int(self.sequence("python").generate_state(1)[0]))
+
+    def rows(self, name, step=0, start=0):
+        """Per-row draws for a phase, for rows from `start` onwards"""
+        return RowRandom(self, name, step, start)
+
+
+class RowRandom():
+    """Stands in for a Generator in the kernels. Row r of every array it
+    returns comes from the generator of r's block, so any slice of rows
+    is the same as the matching slice of a draw for the whole population.
+    """
+    def __init__(self, streams, name, step, start=0):
+        self.streams = streams
+        self.name = name
+        self.step = step
+        self.start = start
+
+    def random(self, shape):
+        n = shape[0]
+        width = int(np.prod(shape[1:], dtype=int))
+        out = np.empty((n, width))
+        if n == 0:
+            return out.reshape(shape)
+        stop = self.start + n
+        for block in range(self.start // BLOCK, (stop - 1) // BLOCK + 1):
+            lo = max(block * BLOCK, self.start)
+            hi = min((block + 1) * BLOCK, stop)
+            draw = self.streams.generator(self.name, self.step, block)
+            # draw from the start of the block so row lo gets its own values
+            values = draw.random((hi - block * BLOCK, width))
+            out[lo - self.start:hi - self.start] = values[lo - block * BLOCK:]
+        return out.reshape(shape)
+
+    def integers(self, low, high, shape):
+        low = np.asarray(low)
+        high = np.asarray(high)
+        return low + np.floor(self.random(shape) * (high - low)).astype(int)
@@ -0,0 +1,149 @@
+"""
+Run mkt over a grid of parameters across a pool of worker processes.
+
+    from sweep import sweep
+    results = sweep({"N": [50, 500], "K": [2, 5], "trade": [True, False]},
+                    replicates=10, steps=200, path="sweep.csv")
+
+With converge={"tolerance": 1e-3, ...} (keyword arguments of
+convergence.Convergence) each run stops as soon as it has settled, so
+`steps` is only an upper bound; the step each run converged at is in the
+converged_step column (empty for runs that didn't).
+"""
+import itertools
+import os
+import resource
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from convergence import Convergence
+from model import FLAGS, MODEL_ARGS, mkt
+
+# What build() takes: mkt's arguments, then the model's FLAGS (e.g.
+# consume or units) and every agent's learning_rate, set afterwards
+PARAMS = MODEL_ARGS + tuple(name for name in FLAGS
+                            if name not in MODEL_ARGS) + ("learning_rate",)
+SERIES = ("Mean_Utility", "Mean_Specialization")
+
+
+def expand(grid, replicates=1):
+    """Every combination of the grid values, `replicates` times over.
+    Each run gets a stable run number and, unless the grid sets one, a
+    seed equal to that run number."""
+    names = sorted(grid)
+    runs = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        for rep in range(replicates):
+            params = dict(zip(names, values))
+            params["run"] = len(runs)
+            params["replicate"] = rep
+            params.setdefault("seed", params["run"])
+            runs.append(params)
+    return runs
+
+
+def bounded(params):
+    """params, with a ledger that keeps only the last step's trades unless
+    they set ledger_size: runs here never read it, and an unbounded one
+    grows by N rows a step"""
+    return dict({"ledger_size": params["N"]}, **params)
+
+
+def build(params, converge=None):
+    """The model for one point of a grid. Its collector is an
+    ArrayCollector unless params say otherwise: Mesa's imports pandas,
+    and runs here step with advance() anyway."""
+    params = dict({"collector": "array"}, **params)
+    unknown = set(params) - set(PARAMS + ("run", "replicate"))
+    if unknown:
+        raise ValueError("unknown parameters: %s" %
+                         ", ".join(sorted(unknown)))
+    model = mkt(**{k: v for k, v in params.items() if k in MODEL_ARGS})
+    for name, value in params.items():
+        if name == "learning_rate":
+            for agent in model.ants:
+                agent.learning_rate = value
+        elif name not in MODEL_ARGS + ("run", "replicate"):
+            setattr(model, name, value)
+    if converge is not None:
+        model.convergence = Convergence(**converge)
+    return model
+
+
+def run_series(params, steps, converge=None):
+    """run_one's columns, as a dict of arrays (and of the params' values).
+    The sweep's workers run this, so they never import pandas."""
+    model = build(bounded(params), converge)
+    series = {"step": np.arange(1, steps + 1)}
+    series.update({name: np.empty(steps) for name in SERIES})
+    t = 0
+    while t < steps and model.running:
+        model.advance()  # the means are all that's kept
+        series["Mean_Utility"][t] = model.mean_utility
+        series["Mean_Specialization"][t] = model.mean_specialization
+        t += 1
+    columns = {name: values[:t] for name, values in series.items()}
+    columns.update(params)
+    if converge is not None:
+        columns["converged_step"] = model.converged_step
+    return columns
+
+
+def run_one(params, steps, converge=None):
+    """Run a single model and return its model-level series as columns,
+    stopping early if `converge` is given and the model settles"""
+    import pandas as pd
+    return pd.DataFrame(run_series(params, steps, converge))
+
+
+def run_chunk(chunk, steps, converge=None):
+    return [run_series(params, steps, converge) for params in chunk]
+
+
+def limit_memory(max_memory):
+    """Worker initializer: cap the worker's address space in bytes"""
+    if max_memory:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+
+
+def finished_runs(path):
+    if path is None or not os.path.exists(path):
+        return set()
+    import pandas as pd
+    return set(pd.read_csv(path, usecols=["run"])["run"].unique())
+
+
+def sweep(grid, replicates=1, steps=100, workers=None, chunksize=1,
+          path=None, max_memory=None, converge=None):
+    """Run every point of `grid` `replicates` times for `steps` steps.
+
+    Runs are farmed out `chunksize` at a time to `workers` processes (all
+    cores by default), each limited to `max_memory` bytes if given. Each
+    chunk's rows are appended to the CSV at `path` as soon as it finishes,
+    and runs already in that file are skipped, so an interrupted sweep
+    picks up where it left off. Returns one tidy table with a row per run
+    and step, up to the step each run stopped at.
+    """
+    import pandas as pd
+    done = finished_runs(path)
+    todo = [params for params in expand(grid, replicates)
+            if params["run"] not in done]
+    chunks = [todo[i:i + chunksize] for i in range(0, len(todo), chunksize)]
+    header = path is not None and not os.path.exists(path)
+    with ProcessPoolExecutor(workers, initializer=limit_memory,
+                             initargs=(max_memory,)) as pool:
+        futures = [pool.submit(run_chunk, chunk, steps, converge)
+                   for chunk in chunks]
+        tables = []
+        for future in as_completed(futures):
+            table = pd.concat([pd.DataFrame(columns)
+                               for columns in future.result()])
+            if path is not None:
+                table.to_csv(path, mode="a", header=header, index=False)
+                header = False
+            else:
+                tables.append(table)
+    if path is not None:
+        return pd.read_csv(path)
+    if not tables:
+        return pd.DataFrame(columns=["step", *SERIES, "run"])
+    return pd.concat(tables, ignore_index=True)
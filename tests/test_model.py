@@ -0,0 +1,98 @@
+"""
+Checks that don't need a long run: kernels against amounts worked out by
+hand, and the ways of restoring, forking or splitting up a model, which
+must all give exactly the run an uninterrupted serial model would.
+
+    python -m pytest tests
+"""
+import numpy as np
+import pytest
+import kernels
+from model import mkt
+
+
+def advance(model, steps):
+    for _ in range(steps):
+        model.step()
+    return model
+
+
+def build(vectorized=True, N=200, K=3, **flags):
+    model = mkt(N, K, 10, 10, True, vectorized, seed=7)
+    model.consume = True
+    for name, value in flags.items():
+        setattr(model, name, value)
+    return model
+
+
+def assert_same(a, b):
+    """Bit-identical agents, means and ledger"""
+    for name in ("endowment", "prod_plan", "ppf", "u_params"):
+        assert np.array_equal(
+            np.array([getattr(ant, name) for ant in a.ants]),
+            np.array([getattr(ant, name) for ant in b.ants])), name
+    assert np.array_equal(a.positions(), b.positions())
+    assert a.mean_utility == b.mean_utility
+    assert a.mean_specialization == b.mean_specialization
+    assert a.ledger.count == b.ledger.count
+    ours, theirs = a.ledger.tail(a.ledger.count), b.ledger.tail(
+        b.ledger.count)
+    for name in ours:
+        assert np.array_equal(ours[name], theirs[name]), name
+
+
+def test_sparse_trade():
+    """sparse_trade on three agents holding two of three goods each, where
+    every pair shares exactly one good. Agent 0 makes 2 of good 0 and its
+    partner 1 makes 1, so 0 ends a unit down and 1 a unit up; the other
+    two swaps cancel."""
+    goods = np.array([[0, 1], [0, 2], [1, 2]])
+    endowment = np.full((3, 2), 10.)
+    ppf = np.array([[2., 1.], [1., 1.], [1., 1.]])
+    scale = kernels.sparse_trade(goods, 3, endowment, np.ones((3, 2)), ppf,
+                                 np.array([1, 2, 0]))
+    assert (scale == 1).all()
+    assert (endowment == [[9, 10], [11, 10], [10, 10]]).all()
+
+
+@pytest.mark.parametrize("vectorized", [False, True])
+@pytest.mark.parametrize("local", [None, "cell"])
+def test_restore(tmp_path, vectorized, local):
+    original = advance(build(vectorized, local=local), 5)
+    original.save_checkpoint(str(tmp_path / "check"))
+    restored = mkt.load_checkpoint(str(tmp_path / "check"))
+    assert_same(advance(original, 5), advance(restored, 5))
+
+
+@pytest.mark.parametrize("vectorized", [False, True])
+def test_fork(vectorized):
+    original = advance(build(vectorized), 5)
+    fork = original.fork()
+    assert_same(advance(original, 5), advance(fork, 5))
+
+
+def test_fork_is_independent():
+    original = advance(build(), 5)
+    fork = original.fork()
+    before = original.ppf.copy()
+    fork.ppf[:] = 1
+    assert np.array_equal(original.ppf, before)
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_parallel(dtype):
+    from parallel import Workers
+    from streams import BLOCK
+    # three workers, one slice ending mid-block
+    N = 2 * BLOCK + 100
+    serial = mkt(N, 3, 10, 10, True, True, seed=3, dtype=dtype, local="cell")
+    split = mkt(N, 3, 10, 10, True, True, seed=3, dtype=dtype, local="cell")
+    for model in (serial, split):
+        model.consume = True
+    with Workers(split, 3):
+        advance(split, 3)
+    advance(serial, 3)
+    for name in ("endowment", "prod_plan", "pos"):
+        assert np.array_equal(getattr(serial, name), getattr(split, name))
+    assert serial.mean_utility == split.mean_utility
+    assert serial.ledger.count == split.ledger.count